@@ -0,0 +1,158 @@
+"""
+ASGI エントリポイント
+
+    uvicorn --port $PORT --host 0.0.0.0 asgi:app
+
+main.py の Flask アプリをそのまま ASGI で配信する。
+async ビューはスレッドを使わずサーバーのイベントループ上で直接 await するので、
+1ワーカーで上流待ちのリクエストを大量に同時に抱えられる。
+同期ビュー (静的ファイル等) だけはスレッドプールで実行する。
+"""
+import asyncio
+import inspect
+import io
+import sys
+
+from flask import request, request_started
+
+import main
+
+
+def build_environ(scope, body: bytes) -> dict:
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope["query_string"].decode("latin1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+        "asgi.scope": scope,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1").upper().replace("-", "_")
+        value = value.decode("latin1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            key = name
+        else:
+            key = "HTTP_" + name
+        if key in environ:
+            value = environ[key] + "," + value
+        environ[key] = value
+    return environ
+
+
+class ASGIApp:
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                main.start_background_tasks()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                main.stop_background_tasks()
+                await main.close_clients()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def http(self, scope, receive, send):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        environ = build_environ(scope, body)
+        app = self.flask_app
+        ctx = app.request_context(environ)
+        error = None
+        try:
+            ctx.push()
+            try:
+                response = await self.full_dispatch_request()
+            except Exception as e:
+                error = e
+                response = app.handle_exception(e)
+            await self.send_response(response, environ, send)
+        finally:
+            ctx.pop(error)
+
+    async def full_dispatch_request(self):
+        # Flask.full_dispatch_request と同じ流れで、ビューだけを await する
+        app = self.flask_app
+        try:
+            request_started.send(app, _async_wrapper=app.ensure_sync)
+            rv = app.preprocess_request()
+            if rv is None:
+                rv = await self.dispatch_request()
+        except Exception as e:
+            rv = app.handle_user_exception(e)
+        return app.finalize_request(rv)
+
+    async def dispatch_request(self):
+        app = self.flask_app
+        req = request._get_current_object()
+        if req.routing_exception is not None:
+            app.raise_routing_exception(req)
+        rule = req.url_rule
+        if getattr(rule, "provide_automatic_options", False) and req.method == "OPTIONS":
+            return app.make_default_options_response()
+        view = app.view_functions[rule.endpoint]
+        if inspect.iscoroutinefunction(view):
+            return await view(**req.view_args)
+        return await asyncio.to_thread(view, **req.view_args)
+
+    async def send_response(self, response, environ, send):
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        await send({
+            "type": "http.response.start",
+            "status": int(status.split(" ", 1)[0]),
+            "headers": [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in headers],
+        })
+        body = response.response
+        try:
+            if hasattr(app_iter, "__aiter__"):
+                # main.AsyncBody はループ上でそのまま読む
+                async for chunk in app_iter:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            elif response.is_sequence:
+                for chunk in app_iter:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            else:
+                # ファイル等のブロッキングな iterable はスレッドで読む
+                it = iter(app_iter)
+                while True:
+                    chunk = await asyncio.to_thread(next, it, None)
+                    if chunk is None:
+                        break
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            if hasattr(body, "aclose"):
+                # ループ上で同期 close() を呼ぶと待ち合わせで固まるので aclose を使う
+                await body.aclose()
+            elif hasattr(app_iter, "close"):
+                app_iter.close()
+        await send({"type": "http.response.body", "body": b""})
+
+
+app = ASGIApp(main.app)
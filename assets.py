@@ -0,0 +1,69 @@
+"""
+静的ファイル (css / blog) の事前圧縮とフィンガープリント
+
+起動時にディレクトリ内のファイルを全部メモリに読み込み、
+内容のハッシュ (バージョン) と gzip / brotli 圧縮済みのバイト列を作っておく。
+リクエスト毎に圧縮し直さず、?v=<ハッシュ> 付きの URL は immutable で長期キャッシュさせる。
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import posixpath
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+class Asset:
+    __slots__ = ("data", "encoded", "version", "mimetype")
+
+    def __init__(self, data: bytes, mimetype: str):
+        self.data = data
+        self.mimetype = mimetype
+        self.version = hashlib.sha256(data).hexdigest()[:12]
+        self.encoded = {}  # Content-Encoding -> 圧縮済みバイト列
+        if mimetype.startswith(COMPRESSIBLE):
+            if brotli is not None:
+                self.encoded["br"] = brotli.compress(data, quality=11)
+            # mtime=0 で毎回同じバイト列にする
+            self.encoded["gzip"] = gzip.compress(data, compresslevel=9, mtime=0)
+            # 小さすぎて縮まないものは生のまま返す
+            for encoding, body in list(self.encoded.items()):
+                if len(body) >= len(data):
+                    del self.encoded[encoding]
+
+    def etag(self, encoding=None) -> str:
+        # 圧縮形式ごとにバイト列が違うので強い ETag も分ける
+        return self.version + ("-" + encoding if encoding else "")
+
+
+class StaticAssets:
+    def __init__(self, directory: str):
+        self.directory = os.path.abspath(directory)
+        self.files = {}  # 相対パス (/ 区切り) -> Asset
+        self.scan()
+
+    def scan(self):
+        files = {}
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                rel = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                # charset は Response(mimetype=...) が text/* に付ける
+                mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                with open(path, "rb") as f:
+                    files[rel] = Asset(f.read(), mimetype)
+        self.files = files
+
+    def get(self, name: str):
+        name = posixpath.normpath("/" + name).lstrip("/")
+        return self.files.get(name)
+
+    def version(self, name: str):
+        asset = self.get(name)
+        return asset.version if asset is not None else None
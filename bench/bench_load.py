@@ -0,0 +1,171 @@
+"""
+エンドツーエンドの負荷試験 (上流は bench/fake_upstream.py)
+
+    python bench/bench_load.py [--duration 10] [--concurrency 32] [--cold]
+                               [--routes home,search,watch,channel,channel_more,comments,x_search,thumbnail]
+                               [--latency 0.05 --error-rate 0.05 --hang-rate 0.01 ...]
+
+偽の上流を立て、main.py をそこに向けた uvicorn (asgi:app) を別プロセスで起動し、
+ルート毎の requests/sec と p50 / p95 / p99 を出す。サムネイルも偽の上流から取り、
+共有キャッシュと画像キャッシュは一時ディレクトリに作る (./cache には触らない)。
+--cold を付けるとリクエスト毎に検索語や動画 ID を変えてキャッシュに当たらないようにする。
+上流の遅さ・失敗率の指定は fake_upstream.py と同じ。
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+import httpx  # noqa: E402
+
+import fake_upstream  # noqa: E402
+
+ROUTES = {
+    "home": "/",
+    "search": "/search?q=bench+{n}&page=1",
+    "watch": "/watch?v=bench{n}",
+    "channel": "/channel/UCbench{n}",
+    "channel_more": "/api/channel/UCbench{n}/videos?continuation=page{n}",
+    "comments": "/comments?v=bench{n}",
+    "x_search": "/x/search?q=bench+{n}",
+    "thumbnail": "/thumbnail?v=bench{n}&w=240",
+}
+
+
+def serve(port: int, upstreams: list):
+    """負荷試験用のアプリサーバー (子プロセス側)"""
+    os.chdir(ROOT)
+    import uvicorn
+
+    import main
+    main.apis[:] = [u + "/" for u in upstreams]
+    main.apichannels[:] = main.apis
+    main.apicomments[:] = main.apis
+    main.X_INSTANCES[:] = upstreams
+    main.THUMBNAIL_HOST = upstreams[0]
+
+    import asgi
+    uvicorn.run(asgi.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def percentile(ordered: list, q: float) -> float:
+    if not ordered:
+        return float("nan")
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+async def wait_ready(client: httpx.AsyncClient, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/word/")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise SystemExit("アプリサーバーが起動しませんでした")
+
+
+async def run(base: str, routes: list, duration: float, concurrency: int, cold: bool):
+    latencies = {name: [] for name in routes}
+    errors = {name: 0 for name in routes}
+    counter = 0
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=base,
+        cookies={"sennin": "True"},
+        headers={"Accept-Encoding": "br, gzip"},
+        limits=limits,
+        timeout=60,
+    ) as client:
+        await wait_ready(client)
+        # 最初の1回 (起動直後の取得・テンプレートのコンパイル) は計測に入れない
+        for name in routes:
+            await client.get(ROUTES[name].format(n=0))
+
+        async def worker(offset: int):
+            nonlocal counter
+            i = offset
+            while time.monotonic() < deadline:
+                name = routes[i % len(routes)]
+                i += 1
+                counter += 1
+                url = ROUTES[name].format(n=counter if cold else 0)
+                start = time.monotonic()
+                try:
+                    r = await client.get(url)
+                    await r.aread()
+                    ok = r.status_code < 500
+                except httpx.HTTPError:
+                    ok = False
+                latencies[name].append(time.monotonic() - start)
+                if not ok:
+                    errors[name] += 1
+
+        deadline = time.monotonic() + duration
+        started = time.monotonic()
+        await asyncio.gather(*(worker(n) for n in range(concurrency)))
+        elapsed = time.monotonic() - started
+
+    print(f"{'route':12s} {'requests':>8s} {'errors':>6s} {'req/s':>8s} {'p50':>8s} {'p95':>8s} {'p99':>8s}")
+    total = 0
+    for name in routes:
+        ordered = sorted(latencies[name])
+        total += len(ordered)
+        print(
+            f"{name:12s} {len(ordered):8d} {errors[name]:6d} {len(ordered) / elapsed:8.1f} "
+            f"{percentile(ordered, 0.5) * 1000:6.1f}ms {percentile(ordered, 0.95) * 1000:6.1f}ms "
+            f"{percentile(ordered, 0.99) * 1000:6.1f}ms"
+        )
+    print(f"{'total':12s} {total:8d} {sum(errors.values()):6d} {total / elapsed:8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=10, help="計測する秒数")
+    parser.add_argument("--concurrency", type=int, default=32, help="同時に投げるリクエスト数")
+    parser.add_argument("--routes", default=",".join(ROUTES), help="カンマ区切り (" + ",".join(ROUTES) + ")")
+    parser.add_argument("--cold", action="store_true", help="毎回違う URL にしてキャッシュを外す")
+    parser.add_argument("--app-port", type=int, default=18000)
+    parser.add_argument("--serve", help=argparse.SUPPRESS)
+    fake_upstream.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.app_port, args.serve.split(","))
+        return
+
+    routes = [r for r in args.routes.split(",") if r]
+    for r in routes:
+        if r not in ROUTES:
+            parser.error(f"unknown route: {r}")
+
+    upstreams = fake_upstream.start(args.port, args.instances, fake_upstream.profile_from_args(args))
+    with tempfile.TemporaryDirectory(prefix="sennin-bench-") as tmp:
+        # main の import 時に読まれる
+        env = dict(
+            os.environ,
+            SHARED_CACHE_PATH=os.path.join(tmp, "shared.sqlite3"),
+            IMAGE_CACHE_DIR=os.path.join(tmp, "images"),
+        )
+        server = subprocess.Popen([
+            sys.executable, os.path.abspath(__file__),
+            "--app-port", str(args.app_port), "--serve", ",".join(upstreams),
+        ], env=env)
+        try:
+            asyncio.run(run(f"http://127.0.0.1:{args.app_port}", routes, args.duration, args.concurrency, args.cold))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
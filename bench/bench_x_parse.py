@@ -0,0 +1,55 @@
+"""
+parse_x_tweets のベンチマーク (lxml XPath と BeautifulSoup の比較)
+
+    python bench/bench_x_parse.py [回数]
+
+bench/fixtures/nitter_*.html を両方の方式で読み、
+結果が一致することを確認してから1ページあたりの時間を出す。
+"""
+import glob
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+# main の import 時に ./cache へ共有キャッシュや画像キャッシュを作らせない (終了時に消える)
+_tmp = tempfile.TemporaryDirectory(prefix="sennin-bench-")
+os.environ["SHARED_CACHE_PATH"] = ""
+os.environ["IMAGE_CACHE_DIR"] = os.path.join(_tmp.name, "images")
+
+import main  # noqa: E402
+
+BASE = "https://nitter.net"
+
+
+def bench(func, html, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        func(html, BASE)
+    return (time.perf_counter() - start) / n
+
+
+def run(n):
+    for path in sorted(glob.glob(os.path.join(ROOT, "bench", "fixtures", "nitter_*.html"))):
+        with open(path, encoding="utf-8") as f:
+            html = f.read()
+
+        fast = main._parse_x_tweets_lxml(html, BASE)
+        slow = main._parse_x_tweets_bs4(html, BASE)
+        if fast != slow:
+            raise SystemExit(f"{os.path.basename(path)}: lxml と BeautifulSoup の結果が違います")
+
+        t_fast = bench(main._parse_x_tweets_lxml, html, n)
+        t_slow = bench(main._parse_x_tweets_bs4, html, n)
+        print(
+            f"{os.path.basename(path):28s} {len(html) // 1024:5d}KB {len(fast):3d} tweets  "
+            f"lxml {t_fast * 1000:7.2f}ms  bs4 {t_slow * 1000:7.2f}ms  x{t_slow / t_fast:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
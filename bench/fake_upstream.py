@@ -0,0 +1,144 @@
+"""
+Invidious / Nitter の代わりをするローカルサーバー (ベンチマーク用)
+
+    python bench/fake_upstream.py [--port 18080] [--instances 1]
+                                  [--latency 0.05] [--jitter 0.02]
+                                  [--error-rate 0] [--hang-rate 0] [--hang 30]
+
+bench/fixtures/ の記録済みレスポンスを返す。
+    /api/v1/search, /api/v1/videos/<id>, /api/v1/channels/<id>[/videos|/shorts],
+    /api/v1/comments/<id>, /api/v1/popular  -> invidious_*.json
+    /search (Nitter)                        -> nitter_search.html
+    /vi/<id>/<name>.jpg (サムネイル)         -> thumbnail.jpg
+--latency / --jitter で応答を遅らせ、--error-rate の割合で 503 を、
+--hang-rate の割合で --hang 秒応答しないリクエストを混ぜる。
+--instances N でポートを1つずつずらして N 台立てる (ヘッジ・フェイルオーバーの確認用)。
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+ROUTES = (
+    # (パスの正規表現, フィクスチャ, Content-Type)
+    (r"/api/v1/search", "invidious_search.json", "application/json"),
+    (r"/api/v1/videos/[^/]+", "invidious_video.json", "application/json"),
+    (r"/api/v1/channels/[^/]+/videos", "invidious_channel_videos.json", "application/json"),
+    (r"/api/v1/channels/[^/]+/shorts", "invidious_channel_shorts.json", "application/json"),
+    (r"/api/v1/channels/[^/]+", "invidious_channel.json", "application/json"),
+    (r"/api/v1/comments/[^/]+", "invidious_comments.json", "application/json"),
+    (r"/api/v1/popular", "invidious_popular.json", "application/json"),
+    (r"/search", "nitter_search.html", "text/html; charset=utf-8"),
+    (r"/vi/[^/]+/\w+\.jpg", "thumbnail.jpg", "image/jpeg"),
+)
+ROUTES = tuple((re.compile(pattern + "$"), name, content_type) for pattern, name, content_type in ROUTES)
+
+
+def load_fixtures() -> dict:
+    fixtures = {}
+    for _, name, _ in ROUTES:
+        with open(os.path.join(FIXTURES, name), "rb") as f:
+            fixtures[name] = f.read()
+    return fixtures
+
+
+class Profile:
+    """応答の遅さ・失敗のさせ方"""
+
+    def __init__(self, latency=0.05, jitter=0.02, error_rate=0.0, hang_rate=0.0, hang=30.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang = hang
+
+
+def make_handler(profile: Profile, fixtures: dict):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_body(self, status: int, body: bytes, content_type: str):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # ヘッジで負けたリクエストはアプリ側から切られる
+                self.close_connection = True
+
+        def do_GET(self):
+            path = urllib.parse.urlsplit(self.path).path
+            for pattern, name, content_type in ROUTES:
+                if pattern.match(path):
+                    break
+            else:
+                self.send_body(404, b"not found", "text/plain")
+                return
+
+            r = random.random()
+            if r < profile.hang_rate:
+                time.sleep(profile.hang)
+                self.close_connection = True
+                return
+            time.sleep(max(0.0, random.gauss(profile.latency, profile.jitter)))
+            if r < profile.hang_rate + profile.error_rate:
+                self.send_body(503, b"upstream error", "text/plain")
+                return
+
+            body = fixtures[name]
+            if name == "invidious_video.json":
+                # 署名付き URL の期限は今から6時間後にする (get_data の TTL 計算用)
+                body = body.replace(b"__EXPIRE__", str(int(time.time()) + 6 * 60 * 60).encode())
+            self.send_body(200, body, content_type)
+
+    return Handler
+
+
+def start(port: int = 18080, instances: int = 1, profile: Profile = None) -> list:
+    """バックグラウンドのスレッドでサーバーを立て、各インスタンスのベース URL を返す"""
+    profile = profile or Profile()
+    handler = make_handler(profile, load_fixtures())
+    urls = []
+    for n in range(instances):
+        server = ThreadingHTTPServer(("127.0.0.1", port + n), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        urls.append(f"http://127.0.0.1:{port + n}")
+    return urls
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--instances", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.05, help="平均応答時間 (秒)")
+    parser.add_argument("--jitter", type=float, default=0.02, help="応答時間の標準偏差 (秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="503 を返す割合")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="応答しない割合")
+    parser.add_argument("--hang", type=float, default=30.0, help="応答しないときに待たせる秒数")
+
+
+def profile_from_args(args) -> Profile:
+    return Profile(args.latency, args.jitter, args.error_rate, args.hang_rate, args.hang)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    add_arguments(parser)
+    args = parser.parse_args()
+    for url in start(args.port, args.instances, profile_from_args(args)):
+        print(url)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
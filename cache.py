@@ -1,16 +1,84 @@
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import lru_cache, wraps
 from threading import Lock
+import asyncio
+import inspect
+import os
 import time
 
 
-def cache(seconds: int, max_size: int = 128, typed: bool = False):
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+_KWD_MARK = (object(),)
+
+# メトリクス用に、デコレートした関数を名前で引けるようにしておく
+registry = {}
+
+# cache(shared=True) が使うワーカー間共有の保存先 (sharedcache.SqliteStore など)
+_shared_store = None
+# 他のプロセスが取得中のキーの結果を待つときの確認間隔と、取得の権利 (lease) の長さ
+SHARED_POLL_INTERVAL = 0.05
+SHARED_LEASE_SECONDS = 15
+# 取得に失敗したことを他のワーカーに伝えておく秒数 (その間は待っていた側も取り直さずに失敗する)
+SHARED_FAILURE_SECONDS = 5
+
+
+class SharedFetchError(Exception):
+    """他のワーカーが同じキーの取得に失敗した"""
+
+
+# 保存先の読み書きは専用のスレッドで行う。既定のスレッドプールは DNS 解決や
+# asyncio.to_thread の他の処理でも使われるので、そちらが詰まると巻き込まれる
+_shared_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="sennin-shared")
+
+
+def use_shared_store(store):
+    global _shared_store
+    _shared_store = store
+
+
+async def _shared_io(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(_shared_executor, func, *args)
+
+
+def _make_key(args, kwargs, typed):
+    key = args
+    if kwargs:
+        key += _KWD_MARK + tuple(sorted(kwargs.items()))
+    if typed:
+        key += tuple(type(v) for v in args)
+        key += tuple(type(v) for v in kwargs.values())
+    return key
+
+
+def cache(seconds: int, max_size: int = 128, typed: bool = False, stale: int = 0, ttl=None, shared: bool = False):
+    """
+    TTL付きキャッシュデコレータ。
+
+    async関数に付けた場合は await 済みの結果をキー毎に保存し、
+    同じキーの同時ミスは1回の呼び出しにまとめる (single-flight)。
+    stale 秒以内の期限切れエントリは古い値を返しつつ、
+    裏で1本だけ再取得を走らせる (stale-while-revalidate)。
+    ttl(結果) を渡すとエントリ毎の有効秒数をそこから決める
+    (None なら seconds、0以下なら保存しない)。
+    shared=True なら use_shared_store() で設定した保存先を介して他のワーカーとも結果を共有し、
+    プロセスをまたいだ同時ミスも1回の呼び出しにまとめる (async関数のみ)。
+    その呼び出しが失敗すると、待っていた他のワーカーも SharedFetchError で失敗する。
+    """
     def wrapper(f):
+        if inspect.iscoroutinefunction(f):
+            return _async_cache(f, seconds, max_size, typed, stale, ttl, shared)
+
         # 1関数につき1つのLockを共有
         lock = Lock()
 
         # lru_cacheを適用
         func = lru_cache(maxsize=max_size, typed=typed)(f)
 
+        # TTL で消した件数 (メトリクス用)
+        evictions = [0]
+
         # TTL（秒）
         func.ttl = seconds
         # 単調増加クロックで期限を管理
@@ -23,6 +91,7 @@ def cache(seconds: int, max_size: int = 128, typed: bool = False):
             # TTL判定とクリアを排他制御
             with lock:
                 if now > func.expire:
+                    evictions[0] += func.cache_info().currsize
                     func.cache_clear()
                     func.expire = now + func.ttl
 
@@ -33,6 +102,184 @@ def cache(seconds: int, max_size: int = 128, typed: bool = False):
         inner.clear_cache = func.cache_clear
         inner.cache_info = func.cache_info
 
+        def cache_stats():
+            info = func.cache_info()
+            return {"hits": info.hits, "misses": info.misses, "evictions": evictions[0], "size": info.currsize}
+
+        inner.cache_stats = cache_stats
+        registry[f.__qualname__] = inner
+
         return inner
 
     return wrapper
+
+
+def _async_cache(f, seconds, max_size, typed, stale, ttl, shared):
+    # スレッド毎に別ループが動いていても共有できるよう
+    # 排他は threading.Lock、待ち合わせは concurrent.futures.Future で行う
+    lock = Lock()
+    entries = OrderedDict()  # key -> (value, expires)
+    inflight = {}            # key -> Future
+    background = set()       # 再検証タスクの参照保持用
+    stats = {"hits": 0, "misses": 0, "evictions": 0, "shared_hits": 0}
+    name = f"{f.__module__}.{f.__qualname__}"
+
+    def lifetime_of(value):
+        if ttl is not None:
+            lifetime = ttl(value)
+            if lifetime is not None:
+                return lifetime
+        return seconds
+
+    def store(key, value, lifetime):
+        if lifetime <= 0:
+            return
+        with lock:
+            entries[key] = (value, time.monotonic() + lifetime)
+            entries.move_to_end(key)
+            while len(entries) > max_size:
+                entries.popitem(last=False)
+                stats["evictions"] += 1
+
+    async def call(args, kwargs):
+        """(値, 有効秒数) を返す。共有の保存先があればそちらを先に見る"""
+        store_ = _shared_store if shared else None
+        if store_ is None:
+            value = await f(*args, **kwargs)
+            return value, lifetime_of(value)
+
+        # プロセスをまたいで同じになるキー (_make_key の区切りは object() なので使えない)
+        skey = name + ":" + repr((args, sorted(kwargs.items())))
+        owner = f"{os.getpid()}:{os.urandom(8).hex()}"
+        while True:
+            try:
+                hit = await _shared_io(store_.get, skey)
+                if hit is not None:
+                    if isinstance(hit[0], SharedFetchError):
+                        raise hit[0]
+                    with lock:
+                        stats["shared_hits"] += 1
+                    return hit
+                acquired = await _shared_io(store_.acquire, skey, owner, SHARED_LEASE_SECONDS)
+            except SharedFetchError:
+                raise
+            except Exception:
+                # 保存先が使えなければ共有せずに取得する
+                value = await f(*args, **kwargs)
+                return value, lifetime_of(value)
+
+            if acquired:
+                try:
+                    try:
+                        value = await f(*args, **kwargs)
+                    except Exception as e:
+                        # 待っている他のワーカーが1つずつ取り直さないよう、失敗もしばらく共有する
+                        failure = SharedFetchError(f"{type(e).__name__}: {e}")
+                        try:
+                            await _shared_io(store_.set, skey, failure, SHARED_FAILURE_SECONDS)
+                        except Exception:
+                            pass
+                        raise
+                    lifetime = lifetime_of(value)
+                    if lifetime > 0:
+                        try:
+                            await _shared_io(store_.set, skey, value, lifetime)
+                        except Exception:
+                            pass
+                    return value, lifetime
+                finally:
+                    # キャンセルされていても返せるよう、待たずに専用スレッドへ渡す
+                    _shared_executor.submit(store_.release, skey, owner)
+
+            # 他のプロセスが取得中なので書き込まれるのを待つ
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
+
+    async def load(key, fut, args, kwargs):
+        try:
+            value, lifetime = await call(args, kwargs)
+        except asyncio.CancelledError:
+            with lock:
+                inflight.pop(key, None)
+            fut.cancel()
+            raise
+        except BaseException as e:
+            with lock:
+                inflight.pop(key, None)
+            fut.set_exception(e)
+            raise
+        store(key, value, lifetime)
+        with lock:
+            inflight.pop(key, None)
+        fut.set_result(value)
+        return value
+
+    async def revalidate(key, fut, args, kwargs):
+        try:
+            await load(key, fut, args, kwargs)
+        except Exception:
+            # 失敗しても古い値を返し続ける
+            pass
+
+    @wraps(f)
+    async def inner(*args, **kwargs):
+        key = _make_key(args, kwargs, typed)
+
+        while True:
+            hit = leader = refresh = fut = None
+            with lock:
+                entry = entries.get(key)
+                now = time.monotonic()
+                if entry is not None and now < entry[1] + stale:
+                    stats["hits"] += 1
+                    entries.move_to_end(key)
+                    hit = entry[0]
+                    if now >= entry[1] and key not in inflight:
+                        refresh = inflight[key] = Future()
+                else:
+                    fut = inflight.get(key)
+                    if fut is None:
+                        stats["misses"] += 1
+                        leader = inflight[key] = Future()
+
+            if fut is None and leader is None:
+                if refresh is not None:
+                    task = asyncio.get_running_loop().create_task(
+                        revalidate(key, refresh, args, kwargs)
+                    )
+                    background.add(task)
+                    task.add_done_callback(background.discard)
+                return hit
+
+            if leader is not None:
+                return await load(key, leader, args, kwargs)
+
+            # 先行している呼び出しの結果を待つ
+            try:
+                return await asyncio.shield(asyncio.wrap_future(fut))
+            except asyncio.CancelledError:
+                if fut.cancelled():
+                    # 先行側がキャンセルされた場合は自分で取り直す
+                    continue
+                raise
+
+    def cache_clear():
+        with lock:
+            entries.clear()
+            for k in stats:
+                stats[k] = 0
+
+    def cache_info():
+        with lock:
+            return CacheInfo(stats["hits"], stats["misses"], max_size, len(entries))
+
+    def cache_stats():
+        with lock:
+            return dict(stats, size=len(entries))
+
+    # 外部から操作できるよう公開
+    inner.clear_cache = cache_clear
+    inner.cache_info = cache_info
+    inner.cache_stats = cache_stats
+    registry[f.__qualname__] = inner
+
+    return inner
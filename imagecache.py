@@ -0,0 +1,210 @@
+"""
+サムネイル等の画像をディスクに保存するキャッシュと、縮小/形式変換
+
+合計サイズが max_bytes を超えたら最後に使われたのが古い順に消す (LRU)。
+複数のワーカーで同じディレクトリを共有できる。
+同じキーの同時ミスは1回の取得にまとめる。
+縮小版 (WebP/AVIF) の生成には Pillow を使い、無ければ元画像をそのまま返す。
+"""
+from collections import OrderedDict
+import asyncio
+import hashlib
+import os
+import time
+
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+# srcset 用に許可する幅。キャッシュの種類が増えすぎないよう近い段に丸める
+IMAGE_WIDTHS = (120, 240, 320, 480, 640, 960, 1280)
+
+FORMATS = {
+    # 形式: (拡張子, mimetype, Pillow の保存オプション)
+    "avif": (".avif", "image/avif", {"quality": 55}),
+    "webp": (".webp", "image/webp", {"quality": 75, "method": 4}),
+    "jpeg": (".jpg", "image/jpeg", {"quality": 80, "optimize": True, "progressive": True}),
+}
+
+if Image is not None:
+    SUPPORTED = [f for f in ("avif", "webp") if features.check(f)] + ["jpeg"]
+else:
+    SUPPORTED = []
+
+
+def snap_width(width):
+    if not width or width <= 0:
+        return None
+    for w in IMAGE_WIDTHS:
+        if width <= w:
+            return w
+    return IMAGE_WIDTHS[-1]
+
+
+def pick_format(accept: str):
+    """Accept ヘッダから返せる一番軽い形式を選ぶ。変換できなければ None"""
+    accept = accept or ""
+    for f in SUPPORTED:
+        if f == "jpeg" or f"image/{f}" in accept:
+            return f
+    return None
+
+
+def sniff_mimetype(path: str) -> str:
+    with open(path, "rb") as f:
+        head = f.read(12)
+    if head.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG"):
+        return "image/png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    if head[:3] == b"GIF":
+        return "image/gif"
+    if head[4:12] in (b"ftypavif", b"ftypavis"):
+        return "image/avif"
+    return "application/octet-stream"
+
+
+def make_variant(src: str, dst: str, width, fmt: str):
+    """src を幅 width 以下に縮小して fmt で dst に保存する (拡大はしない)"""
+    with Image.open(src) as im:
+        im.load()
+        if fmt == "jpeg" and im.mode != "RGB":
+            im = im.convert("RGB")
+        elif im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+        if width and width < im.width:
+            im = im.resize((width, max(1, round(im.height * width / im.width))), Image.LANCZOS)
+        im.save(dst, format=fmt.upper(), **FORMATS[fmt][2])
+
+
+class DiskCache:
+    """
+    同じディレクトリを複数のワーカープロセスで使ってもよい。最終利用時刻はファイルの atime に持ち
+    (mtime は ETag / Last-Modified に使われるので変えない)、
+    合計サイズは時々ディレクトリを数え直して全プロセス分で判断する
+    (数え直すまでの間は他のプロセスが書いた分だけ max_bytes を超えることがある)。
+    """
+
+    # ディレクトリを数え直す間隔 (秒)
+    SCAN_INTERVAL = 60
+    # これより古い一時ファイルは書きかけのまま落ちたものとして消す
+    STALE_TMP_SECONDS = 600
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.total = 0
+        self.index = OrderedDict()  # filename -> size (古い順)
+        self.inflight = {}          # filename -> Task
+        self.scanning = None        # 数え直し中の Task
+        os.makedirs(self.directory, exist_ok=True)
+        self.index, self.total = self._scan()
+        self.next_scan = time.monotonic() + self.SCAN_INTERVAL
+
+    def _scan(self):
+        """ディレクトリの中身から (index, 合計) を作り直し、超えていれば古い順に消す"""
+        # 再起動しても既存ファイルを使い回す。atime を最終利用時刻として扱う
+        files = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+                if name.endswith(".tmp"):
+                    # 他のプロセスが書いている途中のものは残す
+                    if st.st_mtime < now - self.STALE_TMP_SECONDS:
+                        os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            files.append((st.st_atime, name, st.st_size))
+        index = OrderedDict()
+        total = 0
+        for _, name, size in sorted(files):
+            index[name] = size
+            total += size
+        while total > self.max_bytes and index:
+            name, size = index.popitem(last=False)
+            total -= size
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+        return index, total
+
+    async def _rescan(self):
+        # 数え直している間に書かれたものは index から漏れるが、次に使われたときに _fill で戻る
+        try:
+            self.index, self.total = await asyncio.to_thread(self._scan)
+        except OSError:
+            pass
+        finally:
+            self.scanning = None
+            self.next_scan = time.monotonic() + self.SCAN_INTERVAL
+
+    def filename(self, key: str, ext: str) -> str:
+        return hashlib.sha1(key.encode()).hexdigest() + ext
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def _touch(path: str):
+        """他のプロセスの数え直しからも最近使ったものに見えるよう atime だけを今にする"""
+        st = os.stat(path)
+        os.utime(path, (time.time(), st.st_mtime))
+
+    def _forget(self, name: str):
+        size = self.index.pop(name, None)
+        if size is not None:
+            self.total -= size
+
+    async def get(self, key: str, ext: str, fill) -> str:
+        """
+        key に対応するファイルのパスを返す。
+        無ければ (他のプロセスに消された場合も) fill(一時ファイルのパス) で書き込ませてから保存する。
+        """
+        name = self.filename(key, ext)
+        if name in self.index:
+            path = self.path(name)
+            try:
+                self._touch(path)
+            except FileNotFoundError:
+                self._forget(name)
+            else:
+                self.index.move_to_end(name)
+                return path
+
+        task = self.inflight.get(name)
+        if task is None:
+            task = self.inflight[name] = asyncio.ensure_future(self._fill(name, fill))
+            task.add_done_callback(lambda _: self.inflight.pop(name, None))
+        return await asyncio.shield(task)
+
+    async def _fill(self, name: str, fill) -> str:
+        path = self.path(name)
+        if os.path.exists(path):
+            self._touch(path)
+        else:
+            await self._download(path, fill)
+        size = os.path.getsize(path)
+        self._forget(name)
+        self.index[name] = size
+        self.total += size
+        if self.scanning is None and (self.total > self.max_bytes or time.monotonic() >= self.next_scan):
+            self.scanning = asyncio.ensure_future(self._rescan())
+        return path
+
+    async def _download(self, path: str, fill):
+        # 他のプロセスが同じファイルを書いていても混ざらないよう pid 付きの一時ファイルに書いて置き換える
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            await fill(tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
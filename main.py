@@ -5,28 +5,96 @@ import datetime
 import os
 import asyncio
 import base64
+import re
+import random
+import threading
+import contextvars
+import zlib
+import inspect
+import logging
+import hmac
+from functools import wraps
 
 # cache.py が同ディレクトリに存在することを前提としています
 try:
-    from cache import cache
+    from cache import cache, registry as cache_registry, use_shared_store, SharedFetchError
 except ImportError:
+    cache_registry = {}
+    class SharedFetchError(Exception):
+        pass
+    def use_shared_store(store):
+        pass
     # キャッシュデコレータのスタブ（cache.pyがない場合用）
-    def cache(seconds=30):
+    def cache(seconds=30, **kwargs):
         def decorator(f):
             return f
         return decorator
 
-from flask import Flask, request, response, render_template, redirect, make_response, send_from_directory, abort, Response as FlaskResponse
+from flask import Flask, request, render_template, redirect, make_response, send_file, abort, Response as FlaskResponse
 from flask_compress import Compress
+from werkzeug.utils import safe_join
 import httpx
 from bs4 import BeautifulSoup
 
+# ツイート抽出は lxml の XPath を優先 (無ければ BeautifulSoup のみ)
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+from assets import StaticAssets
+from profiler import ProfileSession, Sampler
+import timing
+import metrics
+from pagecache import PageCache
+from sharedcache import SqliteStore
+from upstream import Scoreboard
+from imagecache import DiskCache, FORMATS, make_variant, pick_format, snap_width, sniff_mimetype
+
+# ストリーミング描画の圧縮に使う (Flask-Compress の依存で通常は入っている)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# orjson が入っていれば bytes から直接デコードする (無ければ標準の json)
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# HTTP/2 は h2 が入っている場合のみ有効化
+try:
+    import h2  # noqa: F401
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
 # =========================
 # 基本設定
 # =========================
 
 max_api_wait_time = 3
 max_time = 10
+
+# ヘッジリクエスト: まず一番良いインスタンスにだけ投げ、
+# api_hedge_delay 秒 (None なら そのインスタンスの p90) 待っても返らなければ次を足す。
+# False にすると従来通り api_fanout 個へ一斉に投げる
+api_hedge = True
+api_hedge_delay = None
+# p90 を出せるだけの実績がまだ無いインスタンスの待ち時間 (起動直後に直列のフェイルオーバーにならないよう短め)
+api_hedge_cold_delay = max_api_wait_time / 10
+api_fanout = 8
+
+# 同じホストの複数ワーカーで上流の結果を共有する SQLite (空にすると共有しない)
+shared_cache_path = os.environ.get("SHARED_CACHE_PATH", "./cache/shared.sqlite3")
+if shared_cache_path:
+    try:
+        use_shared_store(SqliteStore(shared_cache_path))
+    except Exception:
+        # 書き込めないファイルシステムではプロセス内のキャッシュだけにする
+        pass
 version = "1.0"
 
 apis = [
@@ -50,6 +118,35 @@ apis = [
 apichannels = apis.copy()
 apicomments = apis.copy()
 
+# インスタンス毎の成績 (EWMAレイテンシ・成功率・ブレーカー)。
+# エンドポイントによって調子が違うので一覧毎に分けて持つ
+api_board = Scoreboard("api", initial_latency=max_api_wait_time / 2)
+apichannel_board = Scoreboard("apichannel", initial_latency=max_api_wait_time / 2)
+apicomment_board = Scoreboard("apicomment", initial_latency=max_api_wait_time / 2)
+
+# /metrics で出す値
+UPSTREAM_SECONDS = metrics.Histogram(
+    "sennin_upstream_request_seconds", "上流インスタンスへのリクエスト時間", ["pool", "instance", "outcome"],
+)
+UPSTREAM_ERRORS = metrics.Counter(
+    "sennin_upstream_errors_total", "上流インスタンスへのリクエストの失敗数", ["pool", "instance"],
+)
+UPSTREAM_WINS = metrics.Counter(
+    "sennin_upstream_wins_total", "ヘッジ・競争で実際に使われた応答の数", ["pool", "instance"],
+)
+ROUTE_SECONDS = metrics.Histogram(
+    "sennin_request_seconds", "ルート毎のレスポンスヘッダを返すまでの時間", ["route", "method", "status"],
+)
+
+def record_upstream(board, instance, started, ok, outcome=None):
+    elapsed = time.monotonic() - started
+    UPSTREAM_SECONDS.observe(elapsed, board.name, instance, outcome or ("ok" if ok else "error"))
+    if ok:
+        board.record_success(instance, elapsed)
+    else:
+        UPSTREAM_ERRORS.inc(board.name, instance)
+        board.record_failure(instance, elapsed)
+
 if os.path.exists("./senninverify"):
     try:
         os.chmod("./senninverify", 0o755)
@@ -63,6 +160,10 @@ if os.path.exists("./senninverify"):
 class APItimeoutError(Exception):
     pass
 
+class APIRequestError(Exception):
+    """上流がリクエスト自体の誤り (存在しない ID など) を返した。他のインスタンスに聞いても同じ"""
+    pass
+
 # =========================
 # 共通
 # =========================
@@ -70,67 +171,215 @@ class APItimeoutError(Exception):
 def check_cookie(cookie_value) -> bool:
     return cookie_value == "True"
 
+def encode_media_url(url: str) -> str:
+    return base64.urlsafe_b64encode(url.encode()).decode()
+
+def decode_media_url(data: str) -> str:
+    return base64.urlsafe_b64decode(data.encode()).decode()
+
+# リクエスト毎に asyncio.run でループを作り直さないよう、
+# 常駐ループを1本だけバックグラウンドスレッドで回す
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+
+def get_loop():
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=loop.run_forever, name="sennin-loop", daemon=True)
+            _loop_thread.start()
+            _loop = loop
+    return _loop
+
 def run_async(coro):
-    """Flask(同期)からasync関数を呼び出すためのヘルパー"""
-    return asyncio.run(coro)
+    """Flask(同期)からasync関数を呼び出すためのヘルパー(常駐ループ上で実行)"""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+class AsyncBody:
+    """
+    async イテレータをそのままレスポンスボディとして流すためのラッパー。
+    ASGI モードでは asgi.py が async for で読み、
+    WSGI モードでは常駐ループに1チャンクずつ取りに行く。
+    """
+
+    def __init__(self, aiterator, aclose=None):
+        self.aiterator = aiterator
+        self._aclose = aclose
+        self.closed = False
+        # 作られたループとコンテキスト (リクエストコンテキスト含む) で続きを読む
+        self.loop = asyncio.get_running_loop()
+        self.context = contextvars.copy_context()
+
+    def __aiter__(self):
+        return self.aiterator.__aiter__()
+
+    def __iter__(self):
+        it = self.aiterator.__aiter__()
+        while True:
+            try:
+                chunk = self.context.run(
+                    asyncio.run_coroutine_threadsafe, it.__anext__(), self.loop
+                ).result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            if self._aclose is not None:
+                await self._aclose()
+
+    def close(self):
+        if not self.closed:
+            asyncio.run_coroutine_threadsafe(self.aclose(), self.loop).result()
+
+# 投げっぱなしのタスクが GC で消えないよう参照を持っておく
+_background = set()
+
+def spawn(coro):
+    """結果を待たずに裏で走らせる (失敗しても無視する先読み用)"""
+    async def runner():
+        # 裏の処理の時間は呼び出し元リクエストの内訳に入れない
+        timing.clear()
+        try:
+            await coro
+        except Exception:
+            pass
+
+    task = asyncio.get_running_loop().create_task(runner())
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+# 上流への接続はループ毎に1本のクライアントで使い回す (keep-alive)
+_clients = {}
+
+def http_client() -> httpx.AsyncClient:
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = httpx.AsyncClient(
+            headers={"User-Agent": "Mozilla/5.0"},
+            http2=HTTP2,
+            limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=60),
+        )
+    return client
+
+async def close_clients():
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
 
 # =========================
-# 並列API最速勝ち
+# 並列API最速勝ち (ヘッジ)
 # =========================
 
-async def api_request_core(api_list, url):
-    start = time.time()
-    lock = asyncio.Lock()
+def is_request_error(r) -> bool:
+    """
+    インスタンスではなくリクエストの側の誤り (存在しない ID など) を示す応答か。
+    401 / 403 / 451 は API を止めている・こちらを弾いているインスタンスが返すので含めない
+    """
+    if r.status_code in (404, 410):
+        return True
+    if r.status_code == 400:
+        # Invidious は {"error": "..."} で理由を返す
+        try:
+            body = json_loads(r.content)
+        except Exception:
+            return False
+        return isinstance(body, dict) and "error" in body
+    return False
 
+async def api_request_core(api_list, url, board):
     async def fetch(client, api):
+        start = time.monotonic()
         try:
             r = await client.get(api + url, timeout=max_api_wait_time)
-            r.raise_for_status()
-            return api, r.text
+            if not is_request_error(r):
+                r.raise_for_status()
+                decode_start = time.perf_counter()
+                data = json_loads(r.content)
+                decode = time.perf_counter() - decode_start
+        except asyncio.CancelledError:
+            raise
         except:
+            record_upstream(board, api, start, False)
             return None
-
-    async with httpx.AsyncClient(headers={"User-Agent": "Mozilla/5.0"}) as client:
-        tasks = [fetch(client, api) for api in api_list[:8]]
-        # asyncio.as_completed をそのまま利用
-        for fut in asyncio.as_completed(tasks, timeout=max_time):
-            try:
-                result = await fut
-            except asyncio.TimeoutError:
-                continue
-            if not result:
-                continue
-            api, text = result
-            try:
-                json.loads(text)
-            except:
-                continue
-            async with lock:
-                if api in api_list:
-                    api_list.remove(api)
-                    api_list.insert(0, api)
-            return text
+        if is_request_error(r):
+            # 存在しない ID など。インスタンス自体はちゃんと応答しているので失敗には数えず、
+            # 他のインスタンスに聞き直しても同じなのでヘッジもやめる
+            record_upstream(board, api, start, True, "client_error")
+            raise APIRequestError(f"{r.status_code} {url}")
+        record_upstream(board, api, start, True)
+        return api, data, decode
+
+    started = time.perf_counter()
+
+    client = http_client()
+    candidates = board.ranked(api_list)[:api_fanout]
+    tasks = []
+    pending = set()
+
+    def launch():
+        task = asyncio.ensure_future(fetch(client, candidates[len(tasks)]))
+        tasks.append(task)
+        pending.add(task)
+
+    # ヘッジしない場合は最初から全部に投げる
+    for _ in candidates[:1] if api_hedge else candidates:
+        launch()
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_time
+    try:
+        while pending:
+            wait = deadline - loop.time()
+            if wait <= 0:
+                break
+            if len(tasks) < len(candidates):
+                delay = api_hedge_delay
+                if delay is None:
+                    delay = board.percentile(candidates[len(tasks) - 1], default=api_hedge_cold_delay)
+                wait = min(delay, wait)
+            done, pending = await asyncio.wait(pending, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                # APIRequestError はそのまま呼び出し元へ
+                result = t.result()
+                if result is not None:
+                    api, data, decode = result
+                    UPSTREAM_WINS.inc(board.name, api)
+                    timing.record("upstream", time.perf_counter() - started - decode, api)
+                    timing.record("parse", decode)
+                    return data
+            if len(tasks) < len(candidates):
+                # 時間内に返ってこない、または失敗したので予備を1本追加
+                launch()
+    finally:
+        # 負けたリクエストは打ち切ってコネクションをプールに返す
+        for t in tasks:
+            t.cancel()
 
     raise APItimeoutError("API timeout")
 
 async def apirequest(url):
-    return await api_request_core(apis, url)
+    return await api_request_core(apis, url, api_board)
 
 async def apichannelrequest(url):
-    return await api_request_core(apichannels, url)
+    return await api_request_core(apichannels, url, apichannel_board)
 
 async def apicommentsrequest(url):
-    return await api_request_core(apicomments, url)
+    return await api_request_core(apicomments, url, apicomment_board)
 
 # =========================
 # APIラッパー
 # =========================
 
-@cache(seconds=30)
+@cache(seconds=30, stale=300, shared=True)
 async def get_search(q, page):
-    data = json.loads(
-        await apirequest(f"api/v1/search?q={urllib.parse.quote(q)}&page={page}&hl=jp")
-    )
+    data = await apirequest(f"api/v1/search?q={urllib.parse.quote(q)}&page={page}&hl=jp")
 
     results = []
     for i in data:
@@ -168,14 +417,32 @@ async def get_search(q, page):
 # ★ DASH対応
 # =========================
 
+# googlevideo の署名付きURLは ?expire=<unix時刻> (HLS は /expire/<unix時刻>/) で切れる
+EXPIRE_RE = re.compile(r"[?&/]expire[=/](\d+)")
+# 期限ぎりぎりの URL を渡さないよう、この秒数だけ手前で捨てる
+VIDEO_EXPIRE_MARGIN = 5 * 60
+VIDEO_MAX_TTL = 6 * 60 * 60
+
+def video_ttl(data):
+    """get_data の結果をいつまでキャッシュしてよいか (ストリームURLの期限の少し前まで)"""
+    t = data[10]
+    urls = [f.get("url", "") for f in t.get("formatStreams", []) + t.get("adaptiveFormats", [])]
+    urls.append(t.get("hlsUrl") or "")
+    expires = [int(m.group(1)) for m in map(EXPIRE_RE.search, urls) if m]
+    if not expires:
+        return None
+    return min(min(expires) - time.time() - VIDEO_EXPIRE_MARGIN, VIDEO_MAX_TTL)
+
+@cache(seconds=300, max_size=64, ttl=video_ttl, shared=True)
 async def get_data(videoid):
-    t = json.loads(await apirequest("api/v1/videos/" + urllib.parse.quote(videoid)))
+    t = await apirequest("api/v1/videos/" + urllib.parse.quote(videoid))
 
     videourls = [i["url"] for i in t.get("formatStreams", [])]
     hls_url = t.get("hlsUrl")
     nocookie_url = f"https://www.youtube-nocookie.com/embed/{videoid}"
 
     adaptive = t.get("adaptiveFormats", [])
+    dash_start = time.perf_counter()
 
     audio = None
     videos = {}
@@ -208,6 +475,7 @@ async def get_data(videoid):
                 for h in sorted(videos.keys(), reverse=True)
             }
         }
+    timing.record("dash", time.perf_counter() - dash_start)
 
     return (
         [{"id": i["videoId"], "title": i["title"], "author": i["author"], "authorId": i["authorId"]}
@@ -228,19 +496,52 @@ async def get_data(videoid):
 # ★ チャンネル
 # =========================
 
+# 一覧の1ページ目は /channel の初回描画に、続きは下までスクロールしたときに取る
+CHANNEL_TABS = ("videos", "shorts")
+CHANNEL_HOME_SHORTS = 12
+
+def channel_video(i):
+    length = i.get("lengthText") or (str(datetime.timedelta(seconds=i["lengthSeconds"])) if i.get("lengthSeconds") else "")
+    return {
+        "title": i["title"],
+        "id": i["videoId"],
+        "view_count_text": i.get("viewCountText", ""),
+        "length_str": length,
+    }
+
+def channel_short(i):
+    return {"videoId": i["videoId"], "title": i["title"], "viewCountText": i.get("viewCountText", "")}
+
+@cache(seconds=300, max_size=256, shared=True)
+async def get_channel_page(channelid, tab, continuation=None):
+    """チャンネルの動画 / Shorts 一覧の1ページ分と、次のページの continuation を返す"""
+    url = f"api/v1/channels/{urllib.parse.quote(channelid)}/{tab}"
+    if continuation:
+        url += "?continuation=" + urllib.parse.quote(continuation)
+    t = await apichannelrequest(url)
+    convert = channel_video if tab == "videos" else channel_short
+    return [convert(i) for i in t.get("videos", [])], t.get("continuation")
+
+@cache(seconds=300, shared=True)
 async def get_channel(channelid):
-    t = json.loads(await apichannelrequest("api/v1/channels/" + urllib.parse.quote(channelid)))
+    # チャンネル情報と各一覧の1ページ目は同時に取る
+    t, videos_page, shorts_page = await asyncio.gather(
+        apichannelrequest("api/v1/channels/" + urllib.parse.quote(channelid)),
+        get_channel_page(channelid, "videos"),
+        get_channel_page(channelid, "shorts"),
+        return_exceptions=True,
+    )
+    if isinstance(t, BaseException):
+        raise t
 
-    videos = []
-    shorts = []
+    if isinstance(videos_page, BaseException):
+        # 一覧が取れなければチャンネル情報に付いてくる最新動画だけ出す
+        videos_page = [channel_video(i) for i in t.get("latestVideos", [])], None
+    if isinstance(shorts_page, BaseException):
+        shorts_page = [], None
 
-    for i in t.get("latestVideos", []):
-        videos.append({
-            "title": i["title"],
-            "id": i["videoId"],
-            "view_count_text": i.get("viewCountText", ""),
-            "length_str": i.get("lengthText", "")
-        })
+    videos, videos_next = videos_page
+    shorts, shorts_next = shorts_page
 
     return (
         videos,
@@ -251,16 +552,25 @@ async def get_channel(channelid):
             "channelprofile": t.get("description", ""),
             "subscribers_count": t.get("subCountText"),
             "cover_img_url": t["authorBanners"][-1]["url"] if t.get("authorBanners") else None
-        }
+        },
+        {"videos": videos_next, "shorts": shorts_next},
     )
 
 # =========================
 # ホーム
 # =========================
 
-@cache(seconds=30)
-async def get_home():
-    data = json.loads(await apirequest("api/v1/popular?hl=jp"))
+# 人気フィードは裏で定期的に取り直し、リクエスト側は手元の最新版を返すだけにする
+HOME_REFRESH_INTERVAL = 30
+HOME_REFRESH_JITTER = 5
+
+_home_feed = None
+_home_refresher = None
+
+# 各ワーカーの定期更新が上流に二重に取りに行かないよう、次の更新より少し短く共有する
+@cache(seconds=HOME_REFRESH_INTERVAL - HOME_REFRESH_JITTER, shared=True)
+async def fetch_home():
+    data = await apirequest("api/v1/popular?hl=jp")
 
     videos = []
     shorts = []
@@ -277,8 +587,49 @@ async def get_home():
 
     return videos, shorts, channels
 
+async def home_refresher():
+    global _home_feed
+    while True:
+        try:
+            if _home_feed is None:
+                # 起動直後はリクエスト側の取得とまとめる
+                await load_home_now()
+            else:
+                _home_feed = await fetch_home()
+        except Exception:
+            # 失敗しても前回取れたものを出し続ける
+            pass
+        await asyncio.sleep(HOME_REFRESH_INTERVAL + random.uniform(-HOME_REFRESH_JITTER, HOME_REFRESH_JITTER))
+
+@cache(seconds=HOME_REFRESH_INTERVAL)
+async def load_home_now():
+    global _home_feed
+    _home_feed = await fetch_home()
+    return _home_feed
+
+def start_background_tasks():
+    """定期更新タスクを今のループで起動する (何度呼んでもよい)"""
+    global _home_refresher
+    if _home_refresher is None or _home_refresher.done():
+        _home_refresher = asyncio.get_running_loop().create_task(home_refresher())
+
+def stop_background_tasks():
+    global _home_refresher
+    if _home_refresher is not None:
+        _home_refresher.cancel()
+        _home_refresher = None
+
+async def get_home():
+    start_background_tasks()
+    if _home_feed is None:
+        # 起動直後でまだ手元に無いときだけ待つ (同時アクセスは1回にまとめる)
+        return await load_home_now()
+    return _home_feed
+
+# /watch が先読みしたものを iframe の /comments で使うので短めに持つ
+@cache(seconds=120, shared=True)
 async def get_comments(videoid):
-    t = json.loads(await apicommentsrequest("api/v1/comments/" + urllib.parse.quote(videoid) + "?hl=jp"))
+    t = await apicommentsrequest("api/v1/comments/" + urllib.parse.quote(videoid) + "?hl=jp")
     return [{
         "author": i["author"],
         "authoricon": i["authorThumbnails"][-1]["url"],
@@ -289,18 +640,360 @@ async def get_comments(videoid):
 # Flask Setup
 # =========================
 
-app = Flask(__name__, static_folder=None)
+class SenninFlask(Flask):
+    """async ビューを常駐ループで動かす Flask (WSGI モード用)
+
+    ASGI モードでは asgi.py がサーバーのループ上で直接 await する。
+    """
+
+    def ensure_sync(self, func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                return run_async(func(*args, **kwargs))
+            return wrapper
+        return func
+
+app = SenninFlask(__name__, static_folder=None)
+# ストリーミングするページは stream_page がチャンク毎に flush しながら自前で圧縮する
+app.config["COMPRESS_STREAMS"] = False
 Compress(app)
 
+# =========================
+# メトリクス
+# =========================
+
+# TIMING_LOG=1 ならリクエスト毎の内訳を JSON で1行ずつ出す
+TIMING_LOG = os.environ.get("TIMING_LOG") == "1"
+timing_logger = logging.getLogger("sennin.timing")
+if TIMING_LOG:
+    timing_logger.setLevel(logging.INFO)
+    timing_logger.addHandler(logging.StreamHandler())
+
+def route_name():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+def request_info():
+    return {"method": request.method, "path": request.path, "route": route_name()}
+
+def log_timings(t, status, info=None):
+    """info はリクエストコンテキストの外 (送信後) で呼ぶときに request_info() を渡す"""
+    if TIMING_LOG:
+        timing_logger.info(json.dumps(
+            {**(info or request_info()), "status": status, **t.as_dict()},
+            ensure_ascii=False,
+        ))
+
+def wants_full_timing() -> bool:
+    """X-Sennin-Timing: 1 か ?_timing=1 なら、ストリーミングせずに描画して Server-Timing に全部の内訳を載せる"""
+    return (request.headers.get("X-Sennin-Timing") or request.args.get("_timing")) == "1"
+
+def finish_request(environ, status, info=None):
+    """レスポンスを送り終えたとき (ストリーミングなら本文の最後) の後始末。2回目以降は何もしない"""
+    if environ.get("sennin.finished"):
+        return
+    environ["sennin.finished"] = True
+    t = environ.get("sennin.timings")
+    if t is not None:
+        log_timings(t, status, info)
+    session = environ.pop("sennin.profile", None)
+    if session is not None:
+        session.finish()
+
+@app.before_request
+def start_timer():
+    request.environ["sennin.timings"] = timing.begin()
+    session = start_profile()
+    if session is not None:
+        request.environ["sennin.profile"] = session
+
+@app.after_request
+def record_route(resp):
+    t = request.environ.get("sennin.timings")
+    if t is not None:
+        ROUTE_SECONDS.observe(t.elapsed(), route_name(), request.method, str(resp.status_code))
+        # ストリーミングするページはヘッダを送る時点までの内訳になる
+        # (全体はログに出す。開発者ツールで見たいときは wants_full_timing で止められる)
+        resp.headers["Server-Timing"] = t.header()
+    session = request.environ.get("sennin.profile")
+    if session is not None:
+        resp.headers["X-Sennin-Profile"] = os.path.basename(session.path)
+    if not request.environ.get("sennin.log_at_end"):
+        finish_request(request.environ, resp.status_code)
+    return resp
+
+@metrics.collector
+def cache_metrics():
+    caches = [(name, f.cache_stats()) for name, f in cache_registry.items()]
+    caches.append(("page_cache", dict(page_cache.stats, size=len(page_cache.entries))))
+    for key, kind, help in (
+        ("hits", "counter", "キャッシュのヒット数"),
+        ("misses", "counter", "キャッシュのミス数"),
+        ("evictions", "counter", "上限・期限切れで捨てたエントリ数"),
+        ("shared_hits", "counter", "他のワーカーが取得した結果を共有キャッシュから使った数"),
+        ("size", "gauge", "保存しているエントリ数"),
+    ):
+        name = f"sennin_cache_{key}" + ("_total" if kind == "counter" else "")
+        yield name, kind, help, [({"cache": c}, stats.get(key, 0)) for c, stats in caches]
+
+@metrics.collector
+def upstream_metrics():
+    now = time.monotonic()
+    boards = (api_board, apichannel_board, apicomment_board, x_board)
+    yield "sennin_upstream_breaker_open", "gauge", "ブレーカーで外しているインスタンス (1=外している)", [
+        ({"pool": b.name, "instance": i}, int(s.open_until > now)) for b in boards for i, s in b.stats.items()
+    ]
+    yield "sennin_upstream_latency_ewma_seconds", "gauge", "インスタンス毎の EWMA レイテンシ", [
+        ({"pool": b.name, "instance": i}, s.latency) for b in boards for i, s in b.stats.items()
+    ]
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return FlaskResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+# =========================
+# プロファイラ
+# =========================
+
+# PROFILE_TOKEN を設定すると、X-Sennin-Profile ヘッダか ?_profile= に同じ値を付けた
+# リクエストだけをサンプリングして PROFILE_DIR に collapsed 形式で保存する
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_INTERVAL = 0.002
+PROFILE_DIR = "./cache/profiles"
+# 0 より大きければアプリ全体をこの間隔でずっとサンプリングする (/debug/profile で見る)
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0"))
+
+background_sampler = Sampler(PROFILE_SAMPLE_INTERVAL).start() if PROFILE_SAMPLE_INTERVAL > 0 else None
+
+def profile_authorized(token) -> bool:
+    # str 同士の compare_digest は ASCII 以外で TypeError になるのでバイト列で比べる
+    return bool(PROFILE_TOKEN) and bool(token) and hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode())
+
+def start_profile():
+    if request.path.startswith("/debug/"):
+        return None
+    if not profile_authorized(request.headers.get("X-Sennin-Profile") or request.args.get("_profile")):
+        return None
+    # ASGI ならサーバーのループ (= 今のスレッド)、WSGI ならリクエストのスレッドと常駐ループ
+    threads = {threading.get_ident()}
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        get_loop()
+        threads.add(_loop_thread.ident)
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", request.path).strip("_") or "root"
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{os.urandom(3).hex()}.folded"
+    return ProfileSession(os.path.join(PROFILE_DIR, name), PROFILE_INTERVAL, threads)
+
+@app.route("/debug/profiles/<name>")
+def debug_profile_file(name):
+    if not profile_authorized(request.headers.get("X-Sennin-Profile") or request.args.get("_profile")):
+        abort(404)
+    path = safe_join(PROFILE_DIR, name)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    return send_file(path, mimetype="text/plain")
+
+@app.route("/debug/profile")
+def debug_profile():
+    """常時サンプリングの集計 (?reset=1 で読んだあと空にする)"""
+    if background_sampler is None or not profile_authorized(
+        request.headers.get("X-Sennin-Profile") or request.args.get("_profile")
+    ):
+        abort(404)
+    body = background_sampler.collapsed()
+    if request.args.get("reset"):
+        background_sampler.reset()
+    return FlaskResponse(body, content_type="text/plain; charset=utf-8")
+
 # 静的ファイル設定 (FastAPIのmountの代替)
+# 起動時に読み込んで gzip / brotli 済みのものを返す。?v= がハッシュと一致すれば immutable
+css_assets = StaticAssets('./css')
+blog_assets = StaticAssets('./blog')
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+ASSET_PREFIXES = {"/css/": css_assets, "/word/": blog_assets}
+
+def serve_asset(assets, filename):
+    asset = assets.get(filename)
+    if asset is None:
+        abort(404)
+    encoding = request.accept_encodings.best_match(list(asset.encoded)) if asset.encoded else None
+    resp = FlaskResponse(asset.encoded[encoding] if encoding else asset.data, mimetype=asset.mimetype)
+    if encoding:
+        # Content-Encoding が付いていれば Flask-Compress は触らない
+        resp.headers["Content-Encoding"] = encoding
+    resp.vary.add("Accept-Encoding")
+    resp.set_etag(asset.etag(encoding))
+    if request.args.get("v") == asset.version:
+        resp.cache_control.public = True
+        resp.cache_control.max_age = ASSET_MAX_AGE
+        resp.cache_control.immutable = True
+    else:
+        resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
 @app.route('/css/<path:filename>')
 def custom_static_css(filename):
-    return send_from_directory('./css', filename)
+    return serve_asset(css_assets, filename)
 
 @app.route('/word/')
 @app.route('/word/<path:filename>')
 def custom_static_word(filename="index.html"):
-    return send_from_directory('./blog', filename)
+    return serve_asset(blog_assets, filename)
+
+@app.template_global()
+def asset_url(path):
+    """静的ファイルの URL に内容のハッシュを付ける (テンプレート用)"""
+    for prefix, assets in ASSET_PREFIXES.items():
+        if path.startswith(prefix):
+            version = assets.version(path[len(prefix):])
+            return f"{path}?v={version}" if version else path
+    return path
+
+# =========================
+# ストリーミング描画
+# =========================
+
+# True なら head (CSS/JS の参照とページの枠) を先に送り、上流のデータが揃ってから残りを送る
+stream_pages = True
+
+# 上流の取得に失敗したページを自動で読み直す回数 (URL の _retry で数える)
+STREAM_RETRIES = 3
+
+def is_definitive_error(e) -> bool:
+    """読み直しても同じ結果になる失敗か (存在しない ID など。他のワーカーでの失敗も含む)"""
+    if isinstance(e, SharedFetchError):
+        return str(e).startswith(APIRequestError.__name__ + ":")
+    return isinstance(e, APIRequestError)
+
+def stream_error_message(error, retry_url):
+    """retry_url が None なら読み直さない"""
+    if is_definitive_error(error):
+        return '<p style="text-align:center">見つかりませんでした。</p>'
+    if retry_url is None:
+        return '<p style="text-align:center">現在読み込めません。しばらくしてから再読み込みしてください。</p>'
+    # </script> で閉じられないよう < はエスケープしておく
+    target = json.dumps(retry_url).replace("<", "\\u003c")
+    return (
+        '<p style="text-align:center">現在読み込み中です。しばらくお待ちください。</p>'
+        f'<script>setTimeout(function(){{location.replace({target});}},1000);</script>'
+    )
+
+def stream_error_html(head, message):
+    """先に送った head の続きとして、開いているタグを閉じたエラー表示を返す"""
+    html = message
+    if b"<body" not in head:
+        html = "<title>仙人tube</title></head><body>" + html
+    if b"<main" in head:
+        html += "</main>"
+    return (html + "</body></html>").encode()
+
+def stream_compressor(encoding):
+    """チャンク毎に flush する圧縮 (まとめて圧縮すると先に送った head が詰まるため)"""
+    if encoding == "br":
+        c = brotli.Compressor(quality=5)
+        return lambda data, final=False: c.process(data) + (c.finish() if final else c.flush())
+    if encoding == "gzip":
+        c = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        return lambda data, final=False: c.compress(data) + c.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+    return lambda data, final=False: data
+
+# 誰が見ても同じになるページは圧縮済みの HTML を保存しておく
+page_cache = PageCache(max_entries=256)
+
+def serve_cached_page(page):
+    encoding = request.accept_encodings.best_match(page.encodings)
+    resp = FlaskResponse(page.bodies[encoding], content_type="text/html; charset=utf-8")
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    resp.vary.add("Accept-Encoding")
+    resp.set_etag(page.etag(encoding))
+    # Cookie 前提のページなので共有キャッシュには置かせず、毎回 ETag で確認させる
+    resp.cache_control.private = True
+    resp.cache_control.no_cache = True
+    return resp.make_conditional(request)
+
+async def render_page(template, context, load, cache_key=None, cache_seconds=30):
+    """
+    load() は上流のデータを取って (テンプレート名, 追加コンテキスト) を返す。
+    stream_pages なら template の head_only 部分をすぐ送り、揃ってから body_only 部分を送る。
+    template が None (取ってみるまでどのテンプレートか分からない) なら page_head.html の
+    共通部分だけを先に送り、残りは load() が返したテンプレートを head_open=True で描画する。
+    cache_key を渡すと描画結果を cache_seconds 秒 page_cache に保存し、次からはそれを返す。
+    """
+    if cache_key is not None:
+        page = page_cache.get(cache_key)
+        if page is not None:
+            return serve_cached_page(page)
+
+    if not stream_pages or wants_full_timing():
+        page_template, data = await load()
+        with timing.phase("render"):
+            html = render_template(page_template, **context, **data)
+        if cache_key is None:
+            return make_response(html)
+        page = await asyncio.to_thread(page_cache.put, cache_key, html.encode(), cache_seconds)
+        return serve_cached_page(page)
+
+    encoding = request.accept_encodings.best_match(["br", "gzip"] if brotli is not None else ["gzip"])
+    compress = stream_compressor(encoding)
+    # head を送っている間にも上流の取得を進める
+    task = asyncio.ensure_future(load())
+    # 内訳のログとプロファイルの保存は本文を送り終えてから
+    environ = request.environ
+    info = request_info()
+    environ["sennin.log_at_end"] = True
+    status = [200]
+    # 失敗したときの読み直し先 (STREAM_RETRIES 回まで)
+    retry = request.args.get("_retry", 0, type=int)
+    retry_url = None
+    if retry < STREAM_RETRIES:
+        args = request.args.copy()
+        args["_retry"] = str(retry + 1)
+        retry_url = request.path + "?" + urllib.parse.urlencode(list(args.items(multi=True)))
+
+    async def chunks():
+        try:
+            with timing.phase("render_head"):
+                if template is None:
+                    head = render_template("page_head.html", **context).encode()
+                else:
+                    head = render_template(template, head_only=True, **context).encode()
+            yield compress(head)
+            try:
+                page_template, data = await task
+            except Exception as e:
+                # ステータスは送ってしまったので、ページを閉じてログにだけ失敗を残す
+                status[0] = 404 if is_definitive_error(e) else 500
+                yield compress(stream_error_html(head, stream_error_message(e, retry_url)), final=True)
+                return
+            with timing.phase("render"):
+                if template is None:
+                    html = render_template(page_template, head_open=True, **context, **data).encode()
+                else:
+                    html = render_template(page_template, body_only=True, **context, **data).encode()
+            yield compress(html, final=True)
+            if cache_key is not None:
+                # 各形式での圧縮は送り終わってから裏で行う
+                spawn(asyncio.to_thread(page_cache.put, cache_key, head + html, cache_seconds))
+        finally:
+            task.cancel()
+            finish_request(environ, status[0], info)
+
+    body = chunks()
+
+    async def aclose():
+        task.cancel()
+        await body.aclose()
+        # 本文を読み始める前に切断された場合
+        finish_request(environ, status[0], info)
+
+    # 素の AsyncBody のまま渡し、ASGI ではループ上で直接読ませる (ClosingIterator で包まれるとスレッド経由になる)
+    resp = FlaskResponse(AsyncBody(body, aclose), content_type="text/html; charset=utf-8", direct_passthrough=True)
+    if encoding:
+        resp.headers["Content-Encoding"] = encoding
+    resp.vary.add("Accept-Encoding")
+    return resp
 
 # =========================
 # 高画質ストリーム
@@ -310,7 +1003,7 @@ STREAM_API = "https://ytdl-0et1.onrender.com/stream/"
 M3U8_API   = "https://ytdl-0et1.onrender.com/m3u8/"
 
 @app.route("/stream/high")
-def stream_high():
+async def stream_high():
     v = request.args.get("v")
     try:
         return redirect(f"{M3U8_API}{v}")
@@ -322,8 +1015,7 @@ def stream_high():
     except:
         pass
 
-    t_str = run_async(apirequest("api/v1/videos/" + urllib.parse.quote(v)))
-    t = json.loads(t_str)
+    t = (await get_data(v))[10]
     if t.get("hlsUrl"):
         return redirect(t["hlsUrl"])
 
@@ -334,67 +1026,107 @@ def stream_high():
 # =========================
 
 @app.route("/")
-def home():
+async def home():
     sennin = request.cookies.get("sennin")
     if not check_cookie(sennin):
         return redirect("/word")
 
-    videos, shorts, channels = run_async(get_home())
+    async def load():
+        videos, shorts, channels = await get_home()
+        return "home.html", {"videos": videos, "shorts": shorts, "channels": channels}
 
-    resp = make_response(render_template(
-        "home.html",
-        videos=videos,
-        shorts=shorts,
-        channels=channels,
-    ))
+    resp = await render_page("home.html", {}, load, cache_key=("home",), cache_seconds=HOME_REFRESH_INTERVAL)
     resp.set_cookie("sennin", "True", max_age=7 * 24 * 60 * 60)
     return resp
 
+# =========================
+# 検索の次ページ先読み
+# =========================
+
+PREFETCH_MAX = 4               # 同時に走らせる先読みの数
+PREFETCH_DELAY = 0.5           # 表示中のページの取得を優先するため少し待ってから始める
+PREFETCH_THUMB_CONCURRENCY = 4
+
+_prefetching = set()
+
+async def prefetch_search(q, page):
+    """次のページの検索結果とサムネイルを温めておく (上流の調子が悪いときはやらない)"""
+    key = (q, page)
+    if key in _prefetching or len(_prefetching) >= PREFETCH_MAX:
+        return
+    if not api_board.healthy(apis, max_api_wait_time):
+        return
+    _prefetching.add(key)
+    try:
+        await asyncio.sleep(PREFETCH_DELAY)
+        results = await get_search(q, page)
+        ids = [i["id"] for i in results if i["type"] == "video"]
+        for n in range(0, len(ids), PREFETCH_THUMB_CONCURRENCY):
+            await asyncio.gather(
+                *(warm_thumbnail(v) for v in ids[n:n + PREFETCH_THUMB_CONCURRENCY]),
+                return_exceptions=True,
+            )
+    finally:
+        _prefetching.discard(key)
+
 @app.route("/search")
-def search():
-    q = request.args.get("q", "")
+async def search():
+    # 空白の違いだけのクエリは同じページ (キャッシュ) にまとめる
+    q = " ".join(request.args.get("q", "").split())
     page = int(request.args.get("page", 1))
     sennin = request.cookies.get("sennin")
     
     if not check_cookie(sennin):
         return redirect("/")
     
-    results = run_async(get_search(q, page))
-    
-    resp = make_response(render_template(
+    async def load():
+        results = await get_search(q, page)
+        # ほとんどの人は次のページに進むので裏で取っておく
+        spawn(prefetch_search(q, page + 1))
+        return "search.html", {"results": results}
+
+    resp = await render_page(
         "search.html",
-        results=results,
-        word=q,
-        next=f"/search?q={q}&page={page+1}",
-    ))
+        {"word": q, "next": f"/search?q={q}&page={page+1}"},
+        load,
+        cache_key=("search", q, page),
+    )
     resp.set_cookie("sennin", "True", max_age=7 * 24 * 60 * 60)
     return resp
 
+# /watch の head の頭で先に接続を張っておく先 (video.html / shorts.html が読む外部の CSS/JS)
+WATCH_PRECONNECT = (
+    "https://code.jquery.com",
+    "https://cdn.dashjs.org",
+    "https://cdn.jsdelivr.net",
+    "https://fonts.googleapis.com",
+)
+
 @app.route("/watch")
-def watch():
+async def watch():
     v = request.args.get("v")
     sennin = request.cookies.get("sennin")
     
     if not check_cookie(sennin):
         return redirect("/")
 
-    data = run_async(get_data(v))
-    t = data[10]
-
-    if t.get("isShort") is True:
-        template = "shorts.html"
-        context = {
-            "videoid": v,
-            "author": t["author"],
-            "authorid": t["authorId"],
-            "authoricon": t["authorThumbnails"][-1]["url"],
-            "title": t["title"],
-            "hls_url": t.get("hlsUrl"),
-        }
-    else:
-        template = "video.html"
-        context = {
-            "videoid": v,
+    # コメントは iframe で後から読まれるので、動画情報と並行して先に取っておく
+    if v:
+        spawn(get_comments(v))
+
+    async def load():
+        data = await get_data(v)
+        t = data[10]
+
+        if t.get("isShort") is True:
+            return "shorts.html", {
+                "author": t["author"],
+                "authorid": t["authorId"],
+                "authoricon": t["authorThumbnails"][-1]["url"],
+                "title": t["title"],
+                "hls_url": t.get("hlsUrl"),
+            }
+        return "video.html", {
             "videourls": data[1],
             "res": data[0],
             "description": data[2],
@@ -407,31 +1139,50 @@ def watch():
             "dash": data[9],
         }
 
-    resp = make_response(render_template(template, **context))
+    # Shorts かどうかは取ってみるまで分からないので、どちらのページにも使える head の頭だけを先に送る
+    resp = await render_page(None, {"videoid": v, "preconnect": WATCH_PRECONNECT}, load)
     resp.set_cookie("sennin", "True", max_age=7 * 24 * 60 * 60)
     return resp
 
 @app.route("/channel/<cid>")
-def channel(cid):
+async def channel(cid):
     sennin = request.cookies.get("sennin")
     if not check_cookie(sennin):
         return redirect("/")
 
-    videos, shorts, info = run_async(get_channel(cid))
-
-    resp = make_response(render_template(
-        "channel.html",
-        results=videos,
-        shorts=shorts,
-        channelname=info["channelname"],
-        channelicon=info["channelicon"],
-        channelprofile=info["channelprofile"],
-        subscribers_count=info["subscribers_count"],
-        cover_img_url=info["cover_img_url"],
-    ))
+    async def load():
+        videos, shorts, info, continuations = await get_channel(cid)
+        return "channel.html", {
+            "channelid": cid,
+            "results": videos,
+            "shorts": shorts,
+            "home_shorts": shorts[:CHANNEL_HOME_SHORTS],
+            "continuations": continuations,
+            "channelname": info["channelname"],
+            "channelicon": info["channelicon"],
+            "channelprofile": info["channelprofile"],
+            "subscribers_count": info["subscribers_count"],
+            "cover_img_url": info["cover_img_url"],
+        }
+
+    resp = await render_page("channel.html", {}, load, cache_key=("channel", cid), cache_seconds=120)
     resp.set_cookie("sennin", "True", max_age=7 * 24 * 60 * 60)
     return resp
 
+@app.route("/api/channel/<cid>/<tab>")
+async def channel_more(cid, tab):
+    """channel.html が下までスクロールしたときに読む続きのページ"""
+    if tab not in CHANNEL_TABS:
+        abort(404)
+    continuation = request.args.get("continuation")
+    if not continuation:
+        abort(400)
+    items, next_continuation = await get_channel_page(cid, tab, continuation)
+    return {
+        "html": render_template("channel_items.html", tab=tab, items=items),
+        "continuation": next_continuation,
+    }
+
 @app.route("/subuscript")
 def subuscript():
     sennin = request.cookies.get("sennin")
@@ -440,22 +1191,115 @@ def subuscript():
     return render_template("subuscript.html")
 
 @app.route("/comments")
-def comments():
+async def comments():
     v = request.args.get("v")
-    comment_data = run_async(get_comments(v))
+    comment_data = await get_comments(v)
     return render_template("comments.html", comments=comment_data)
 
+# =========================
+# 画像プロキシ (サムネイル・アイコン・バナー)
+# =========================
+
+# 元画像と縮小版はディスクにキャッシュし、ブラウザにも長めにキャッシュさせる
+thumb_cache = DiskCache(os.environ.get("IMAGE_CACHE_DIR", "./cache/images"), max_bytes=256 * 1024 * 1024)
+THUMB_MAX_AGE = 7 * 24 * 60 * 60
+
+# /img で中継してよいホスト (オープンプロキシにしない)
+IMAGE_HOSTS = (
+    "img.youtube.com",
+    "i.ytimg.com",
+    "yt3.ggpht.com",
+    "yt3.googleusercontent.com",
+)
+
+async def download_to(url: str, path: str):
+    async with http_client().stream("GET", url, timeout=max_api_wait_time) as r:
+        r.raise_for_status()
+        with open(path, "wb") as f:
+            async for chunk in r.aiter_bytes():
+                f.write(chunk)
+
+async def serve_image(url: str):
+    """
+    url の画像を返す。?w= があればその幅に縮小し、
+    Accept を見て AVIF / WebP / JPEG のうち返せる一番軽い形式に変換する。
+    """
+    try:
+        return await send_image(url)
+    except FileNotFoundError:
+        # get() から send_file までの間に他のワーカーの数え直しで消された。取り直す
+        return await send_image(url)
+
+async def send_image(url: str):
+    try:
+        src = await thumb_cache.get(url, ".img", lambda tmp: download_to(url, tmp))
+    except Exception:
+        abort(404)
+
+    width = snap_width(request.args.get("w", type=int))
+    fmt = pick_format(request.headers.get("Accept"))
+    if fmt is None:
+        # Pillow が無い場合は元画像をそのまま返す
+        return send_file(src, mimetype=sniff_mimetype(src), conditional=True, max_age=THUMB_MAX_AGE)
+
+    ext, mimetype, _ = FORMATS[fmt]
+    try:
+        path = await thumb_cache.get(
+            f"{url}|{width}|{fmt}", ext,
+            lambda tmp: asyncio.to_thread(make_variant, src, tmp, width, fmt),
+        )
+    except Exception:
+        # Pillow が読めない画像 (SVG 等) や変換の失敗は元画像をそのまま返す
+        return send_file(src, mimetype=sniff_mimetype(src), conditional=True, max_age=THUMB_MAX_AGE)
+    # conditional=True で If-None-Match / If-Modified-Since に 304 を返す
+    resp = send_file(path, mimetype=mimetype, conditional=True, max_age=THUMB_MAX_AGE)
+    resp.vary.add("Accept")
+    return resp
+
+# /thumbnail の取得元 (負荷試験では偽の上流に向ける)
+THUMBNAIL_HOST = "https://img.youtube.com"
+
+def thumbnail_source(videoid: str) -> str:
+    return f"{THUMBNAIL_HOST}/vi/{urllib.parse.quote(videoid)}/0.jpg"
+
+async def warm_thumbnail(videoid: str):
+    url = thumbnail_source(videoid)
+    await thumb_cache.get(url, ".img", lambda tmp: download_to(url, tmp))
+
 @app.route("/thumbnail")
-def thumbnail():
-    v = request.args.get("v")
-    
-    async def fetch_thumb():
-        async with httpx.AsyncClient() as client:
-            r = await client.get(f"https://img.youtube.com/vi/{v}/0.jpg")
-            return r.content
-            
-    content = run_async(fetch_thumb())
-    return FlaskResponse(content, mimetype="image/jpeg")
+async def thumbnail():
+    return await serve_image(thumbnail_source(request.args.get("v", "")))
+
+@app.route("/img")
+async def image_proxy():
+    try:
+        url = decode_media_url(request.args.get("u", ""))
+    except Exception:
+        abort(400)
+    if url.startswith("//"):
+        url = "https:" + url
+    if urllib.parse.urlsplit(url).hostname not in IMAGE_HOSTS or not url.startswith("https://"):
+        abort(400)
+    return await serve_image(url)
+
+@app.template_global()
+def image_url(url, w=None):
+    """外部画像を /img 経由の URL にする (テンプレート用)"""
+    if not url:
+        return url
+    if url.startswith("//"):
+        url = "https:" + url
+    if urllib.parse.urlsplit(url).hostname not in IMAGE_HOSTS:
+        return url
+    return "/img?u=" + encode_media_url(url) + (f"&w={w}" if w else "")
+
+@app.template_global()
+def thumb_url(videoid, w=None):
+    return "/thumbnail?v=" + urllib.parse.quote(videoid or "") + (f"&w={w}" if w else "")
+
+@app.template_global()
+def thumb_srcset(videoid, widths=(240, 480)):
+    return ", ".join(f"{thumb_url(videoid, w)} {w}w" for w in widths)
 
 # ============================================================
 # ★★★ X (Nitter系) 統合 ★★★
@@ -467,25 +1311,87 @@ X_INSTANCES = [
     "https://nuku.trabun.org",
 ]
 
+# Nitter インスタンス毎の成績
+x_board = Scoreboard("x", initial_latency=max_api_wait_time / 2)
+
+def is_x_timeline(html: str) -> bool:
+    # レート制限・captcha・Cloudflare のページは 200 でもタイムラインが無い
+    # (検索結果0件でも timeline-none として timeline クラスは出る)
+    return 'class="timeline' in html
+
 async def x_fetch(path: str):
-    async with httpx.AsyncClient(headers={"User-Agent": "Mozilla/5.0"}, timeout=max_api_wait_time) as client:
-        for base in X_INSTANCES:
-            try:
-                r = await client.get(base + path, follow_redirects=True)
-                r.raise_for_status()
-                return r.text, base
-            except:
-                continue
+    async def fetch(client, base):
+        start = time.monotonic()
+        try:
+            r = await client.get(base + path, follow_redirects=True, timeout=max_api_wait_time)
+            r.raise_for_status()
+            html = r.text
+            if not is_x_timeline(html):
+                raise ValueError("no timeline")
+        except asyncio.CancelledError:
+            raise
+        except:
+            record_upstream(x_board, base, start, False)
+            return None
+        record_upstream(x_board, base, start, True)
+        return html, base
+
+    # 順番に試すと落ちているインスタンスの数だけ待たされるので同時に投げる
+    started = time.perf_counter()
+    client = http_client()
+    tasks = [asyncio.ensure_future(fetch(client, base)) for base in x_board.ranked(X_INSTANCES)]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            result = await fut
+            if result is not None:
+                UPSTREAM_WINS.inc(x_board.name, result[1])
+                timing.record("upstream", time.perf_counter() - started, result[1])
+                return result
+    finally:
+        for t in tasks:
+            t.cancel()
     raise APItimeoutError("X fetch failed")
 
-def encode_media_url(url: str) -> str:
-    return base64.urlsafe_b64encode(url.encode()).decode()
+def _x_class(name: str) -> str:
+    # CSS の .name と同じく class 属性を空白区切りで見る
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+if etree is not None:
+    _X_PARSER = etree.HTMLParser(encoding="utf-8")
+    _X_ITEMS = etree.XPath(f"//*[{_x_class('timeline-item')}]")
+    _X_CONTENT = etree.XPath(f"(.//*[{_x_class('tweet-content')}])[1]")
+    _X_IMAGES = etree.XPath(f".//a[{_x_class('still-image')}]//img/@src")
+    _X_VIDEOS = etree.XPath(".//video//source/@src")
+
+def _x_media_url(src: str, base: str) -> str:
+    if not src.startswith("http"):
+        src = base + src
+    return "/x/media?u=" + encode_media_url(src)
+
+def _parse_x_tweets_lxml(html: str, base: str):
+    root = etree.fromstring(html.encode("utf-8"), _X_PARSER)
+    if root is None:
+        return []
+    tweets = []
 
-def decode_media_url(data: str) -> str:
-    return base64.urlsafe_b64decode(data.encode()).decode()
+    for item in _X_ITEMS(root):
+        content = _X_CONTENT(item)
+        if not content:
+            continue
 
-def parse_x_tweets(html: str, base: str):
-    soup = BeautifulSoup(html, "lxml")
+        # BeautifulSoup の get_text("\n", strip=True) と同じ結果になるようにする
+        text = "\n".join(s for s in (t.strip() for t in content[0].itertext()) if s)
+
+        tweets.append({
+            "text": text,
+            "images": [_x_media_url(src, base) for src in _X_IMAGES(item) if src],
+            "videos": [_x_media_url(src, base) for src in _X_VIDEOS(item) if src],
+        })
+
+    return tweets
+
+def _parse_x_tweets_bs4(html: str, base: str):
+    soup = BeautifulSoup(html, "lxml" if etree is not None else "html.parser")
     tweets = []
 
     for item in soup.select(".timeline-item"):
@@ -499,17 +1405,13 @@ def parse_x_tweets(html: str, base: str):
         for img in item.select("a.still-image img"):
             src = img.get("src")
             if src:
-                if not src.startswith("http"):
-                    src = base + src
-                images.append("/x/media?u=" + encode_media_url(src))
+                images.append(_x_media_url(src, base))
 
         videos = []
         for v in item.select("video source"):
             src = v.get("src")
             if src:
-                if not src.startswith("http"):
-                    src = base + src
-                videos.append("/x/media?u=" + encode_media_url(src))
+                videos.append(_x_media_url(src, base))
 
         tweets.append({
             "text": text,
@@ -519,25 +1421,35 @@ def parse_x_tweets(html: str, base: str):
 
     return tweets
 
+def parse_x_tweets(html: str, base: str):
+    """Nitter の検索結果からツイートを取り出す。lxml の XPath で直接読み、無ければ BeautifulSoup"""
+    if etree is not None:
+        try:
+            return _parse_x_tweets_lxml(html, base)
+        except (etree.LxmlError, ValueError):
+            pass
+    return _parse_x_tweets_bs4(html, base)
+
+def normalize_x_query(q: str) -> str:
+    # 空白の揺れと大文字小文字の違いは同じ検索として扱う
+    return " ".join(q.split()).lower()
+
+@cache(seconds=60, stale=300, shared=True)
+async def get_x_search(q):
+    """正規化済みクエリで Nitter を検索してツイート一覧を返す (API / ページ共通)"""
+    html, base = await x_fetch("/search?f=tweets&q=" + urllib.parse.quote(q))
+    with timing.phase("parse"):
+        return parse_x_tweets(html, base)
+
 @app.route("/api/x/search")
-@cache(seconds=60)
-def x_search_api():
+async def x_search_api():
     q = request.args.get("q", "")
-    async def get_x():
-        html, base = await x_fetch("/search?f=tweets&q=" + urllib.parse.quote(q))
-        return {"query": q, "tweets": parse_x_tweets(html, base)}
-    
-    return run_async(get_x())
+    return {"query": q, "tweets": await get_x_search(normalize_x_query(q))}
 
 @app.route("/x/search")
-def x_search_page():
+async def x_search_page():
     q = request.args.get("q", "")
-    # APIルートの関数を内部的に呼ぶ
-    async def get_x():
-        html, base = await x_fetch("/search?f=tweets&q=" + urllib.parse.quote(q))
-        return parse_x_tweets(html, base)
-    
-    tweets = run_async(get_x())
+    tweets = await get_x_search(normalize_x_query(q))
     return render_template(
         "x_search.html",
         query=q,
@@ -548,23 +1460,39 @@ def x_search_page():
 # ★★★ X メディアプロキシ ★★★
 # ============================================================
 
+# シーク (Range) やブラウザキャッシュが効くよう上流とやり取りするヘッダ
+MEDIA_REQUEST_HEADERS = ("Range", "If-Range", "If-None-Match", "If-Modified-Since")
+MEDIA_RESPONSE_HEADERS = (
+    "Content-Length", "Content-Range", "Accept-Ranges",
+    "ETag", "Last-Modified", "Cache-Control", "Expires",
+)
+MEDIA_CHUNK_SIZE = 64 * 1024
+
 @app.route("/x/media")
-def x_media_proxy():
+async def x_media_proxy():
     u = request.args.get("u")
     url = decode_media_url(u)
 
     if not url.startswith("https://"):
         abort(400)
 
-    async def fetch_media():
-        async with httpx.AsyncClient(headers={"User-Agent": "Mozilla/5.0"}, timeout=5) as client:
-            r = await client.get(url)
-            r.raise_for_status()
-            return r.content, r.headers.get("content-type", "application/octet-stream")
-
-    content, mime = run_async(fetch_media())
-    return FlaskResponse(content, mimetype=mime)
+    # 全体をメモリに読み込まず、上流から受け取った順にそのまま流す
+    headers = {k: request.headers[k] for k in MEDIA_REQUEST_HEADERS if k in request.headers}
+    headers["Accept-Encoding"] = "identity"
+    client = http_client()
+    r = await client.send(client.build_request("GET", url, headers=headers, timeout=5), stream=True)
+    if r.status_code not in (200, 206, 304, 416):
+        await r.aclose()
+        abort(502)
+
+    return FlaskResponse(
+        AsyncBody(r.aiter_raw(MEDIA_CHUNK_SIZE), r.aclose),
+        status=r.status_code,
+        headers={k: r.headers[k] for k in MEDIA_RESPONSE_HEADERS if k in r.headers},
+        content_type=r.headers.get("content-type", "application/octet-stream"),
+        direct_passthrough=True,
+    )
 
 if __name__ == "__main__":
-    # Flaskの開発用サーバー。本番環境では Waitress や Gunicorn + Gevent を推奨
+    # Flaskの開発用サーバー。本番環境では ASGI モード (uvicorn asgi:app) を推奨
     app.run(host="0.0.0.0", port=8000, debug=True)
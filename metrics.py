@@ -0,0 +1,110 @@
+"""
+Prometheus テキスト形式のメトリクス (/metrics 用)
+
+prometheus_client を入れずに済むよう、必要な Counter / Histogram だけを持つ。
+記録はロック1回と足し算だけなので本番で常に有効にしておける。
+キャッシュのように元から数えている値は、出力するときに collector で読み取る。
+"""
+from bisect import bisect_left
+from threading import Lock
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = []
+_collectors = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{v}"' for n, v in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.values = {}
+        self.lock = Lock()
+        _metrics.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # labels -> [バケット毎の個数..., 合計]
+        self.lock = Lock()
+        _metrics.append(self)
+
+    def observe(self, value: float, *labels):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            v = self.values.get(labels)
+            if v is None:
+                v = self.values[labels] = [0] * (len(self.buckets) + 2)
+            v[i] += 1
+            v[-1] += value
+
+    def render(self):
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.values.items())
+        for labels, v in items:
+            count = 0
+            for bound, n in zip(self.buckets + (float("inf"),), v):
+                count += n
+                le = (("le", _number(bound)),)
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {count}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(v[-1])}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {count}"
+
+
+def collector(f):
+    """
+    出力時に呼ばれる関数を登録する。
+    f() は (名前, 種類, 説明, [(ラベル辞書, 値), ...]) を yield する。
+    """
+    _collectors.append(f)
+    return f
+
+
+def render() -> str:
+    lines = []
+    for m in _metrics:
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(m.render())
+    for f in _collectors:
+        for name, kind, help, samples in f():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{_labels(labels.keys(), labels.values())} {_number(value)}")
+    return "\n".join(lines) + "\n"
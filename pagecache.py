@@ -0,0 +1,72 @@
+"""
+描画済みページのキャッシュ
+
+誰が見ても同じ内容になるページ (ホーム・検索・チャンネル) の HTML を
+gzip / brotli 圧縮済みの形で保存し、次からは辞書を引くだけで返す。
+ETag は圧縮形式ごとの強い ETag で、If-None-Match が一致すれば 304 にできる。
+"""
+from collections import OrderedDict
+from threading import Lock
+import gzip
+import hashlib
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Page:
+    __slots__ = ("version", "bodies", "expires")
+
+    def __init__(self, html: bytes, expires: float):
+        self.version = hashlib.sha256(html).hexdigest()[:16]
+        self.expires = expires
+        self.bodies = {None: html}  # Content-Encoding -> 本文
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(html, quality=9)
+        self.bodies["gzip"] = gzip.compress(html, compresslevel=9, mtime=0)
+
+    @property
+    def encodings(self) -> list:
+        return [e for e in self.bodies if e is not None]
+
+    def etag(self, encoding=None) -> str:
+        return self.version + ("-" + encoding if encoding else "")
+
+
+class PageCache:
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> Page (古い順)
+        self.lock = Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        with self.lock:
+            page = self.entries.get(key)
+            if page is not None and time.monotonic() >= page.expires:
+                del self.entries[key]
+                page = None
+            if page is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["hits"] += 1
+            self.entries.move_to_end(key)
+            return page
+
+    def put(self, key, html: bytes, seconds: float) -> Page:
+        # 圧縮はロックの外で (数十 ms 掛かることがある)
+        page = Page(html, time.monotonic() + seconds)
+        with self.lock:
+            self.entries[key] = page
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return page
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,87 @@
+"""
+サンプリングプロファイラ (flamegraph.pl / speedscope で読める collapsed 形式を出す)
+
+別スレッドから一定間隔で sys._current_frames() を覗いてスタックを数えるだけなので、
+対象のコードには手を入れずに本番で動いているリクエストをそのまま測れる。
+イベントループのスレッドは他のリクエストも同時に処理しているため、
+1リクエスト分のプロファイルにも同時刻の他の処理が混ざることがある。
+"""
+from collections import Counter
+import os
+import sys
+import threading
+
+
+def frame_name(code) -> str:
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+class Sampler:
+    def __init__(self, interval: float, threads=None):
+        """threads はスレッド ID の集合 (None なら自分以外の全スレッド)"""
+        self.interval = interval
+        self.threads = threads
+        self.samples = Counter()
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sennin-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me or (self.threads is not None and ident not in self.threads):
+                    continue
+                name = names.get(ident)
+                if name is None:
+                    names.update((t.ident, t.name) for t in threading.enumerate())
+                    name = names.get(ident, str(ident))
+                stack = name + ";" + collapse(frame)
+                with self.lock:
+                    self.samples[stack] += 1
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+
+    def collapsed(self) -> str:
+        """1行に「スタック;...;関数 回数」の形式"""
+        with self.lock:
+            items = sorted(self.samples.items())
+        return "".join(f"{stack} {count}\n" for stack, count in items)
+
+
+class ProfileSession:
+    """1リクエスト分のプロファイル"""
+
+    def __init__(self, path: str, interval: float, threads):
+        self.path = path
+        self.sampler = Sampler(interval, threads).start()
+
+    def finish(self):
+        self.sampler.stop()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.sampler.collapsed())
+        os.replace(tmp, self.path)
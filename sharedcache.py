@@ -0,0 +1,92 @@
+"""
+ワーカー間で共有するキャッシュ (SQLite)
+
+同じホストで複数のワーカープロセスを動かしても、上流から取った結果を1回で済ませるための
+cache(shared=True) の裏側。期限は time.time() (全プロセス共通の時刻) で持つ。
+同じキーを複数プロセスが同時に取りに行かないよう、先に lease を取れた1プロセスだけが取得し、
+他はその結果 (失敗した場合はその印) が書き込まれるのを待つ (lease の持ち主が落ちても期限が来れば引き継ぐ)。
+
+get / set / acquire / release を持つオブジェクトなら何でも cache.use_shared_store() に渡せる。
+"""
+import os
+import pickle
+import random
+import sqlite3
+import threading
+import time
+
+
+class SqliteStore:
+    def __init__(self, path: str, timeout: float = 1.0, cleanup_every: int = 200):
+        self.path = os.path.abspath(path)
+        self.timeout = timeout
+        self.cleanup_every = cleanup_every
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._conn() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "key TEXT PRIMARY KEY, owner TEXT NOT NULL, until REAL NOT NULL)"
+            )
+
+    def _conn(self) -> sqlite3.Connection:
+        # 接続はスレッド毎・プロセス毎 (fork 後に親の接続を使わない)
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str):
+        """期限内なら (値, 残り秒数)、無ければ None"""
+        now = time.time()
+        row = self._conn().execute(
+            "SELECT value, expires FROM entries WHERE key = ? AND expires > ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0]), row[1] - now
+
+    def set(self, key: str, value, seconds: float):
+        now = time.time()
+        db = self._conn()
+        db.execute(
+            "INSERT OR REPLACE INTO entries (key, value, expires) VALUES (?, ?, ?)",
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now + seconds),
+        )
+        if random.randrange(self.cleanup_every) == 0:
+            # 期限切れの行はたまにまとめて消す
+            db.execute("DELETE FROM entries WHERE expires <= ?", (now,))
+            db.execute("DELETE FROM leases WHERE until <= ?", (now,))
+
+    def acquire(self, key: str, owner: str, seconds: float) -> bool:
+        """key を取得する権利を seconds 秒だけ取る。誰かが持っていれば False"""
+        now = time.time()
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM leases WHERE key = ? AND until <= ?", (key, now))
+            cur = db.execute(
+                "INSERT OR IGNORE INTO leases (key, owner, until) VALUES (?, ?, ?)",
+                (key, owner, now + seconds),
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return cur.rowcount == 1
+
+    def release(self, key: str, owner: str):
+        self._conn().execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+
+    def clear(self):
+        db = self._conn()
+        db.execute("DELETE FROM entries")
+        db.execute("DELETE FROM leases")
@@ -0,0 +1,72 @@
+"""
+リクエスト毎の処理時間の内訳 (Server-Timing ヘッダとログ用)
+
+リクエストの最初に begin() すると、同じコンテキストで動く処理から
+record() / phase() で「上流待ち」「JSON デコード」「描画」などの時間を足していける。
+コンテキスト変数に入れているので、バックグラウンドのループに渡した
+コルーチンからでも同じリクエストの内訳に記録される。
+"""
+from contextlib import contextmanager
+import contextvars
+import time
+
+_current = contextvars.ContextVar("sennin_timings", default=None)
+
+
+class Timings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []  # (名前, 秒, 説明)
+
+    def add(self, name: str, seconds: float, desc: str = None):
+        self.phases.append((name, seconds, desc))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def header(self) -> str:
+        parts = []
+        for name, seconds, desc in self.phases + [("total", self.elapsed(), None)]:
+            part = f"{name};dur={seconds * 1000:.1f}"
+            if desc:
+                part += ';desc="' + desc.replace("\\", "\\\\").replace('"', '\\"') + '"'
+            parts.append(part)
+        return ", ".join(parts)
+
+    def as_dict(self) -> dict:
+        d = {"total_ms": round(self.elapsed() * 1000, 1), "phases": []}
+        for name, seconds, desc in self.phases:
+            phase = {"name": name, "ms": round(seconds * 1000, 1)}
+            if desc:
+                phase["desc"] = desc
+            d["phases"].append(phase)
+        return d
+
+
+def begin() -> Timings:
+    t = Timings()
+    _current.set(t)
+    return t
+
+
+def current():
+    return _current.get()
+
+
+def clear():
+    _current.set(None)
+
+
+def record(name: str, seconds: float, desc: str = None):
+    t = _current.get()
+    if t is not None:
+        t.add(name, seconds, desc)
+
+
+@contextmanager
+def phase(name: str, desc: str = None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start, desc)
@@ -0,0 +1,102 @@
+"""
+上流インスタンス (Invidious / Nitter) の成績表
+
+インスタンス毎に EWMA レイテンシと成功率を記録し、
+連続で失敗したものはクールダウンの間だけ外す (サーキットブレーカー)。
+"""
+from collections import deque
+import time
+
+
+class InstanceStats:
+    __slots__ = ("latency", "success", "failures", "open_until", "cooldown", "samples")
+
+    def __init__(self, latency: float, cooldown: float, window: int):
+        self.latency = latency      # EWMA レイテンシ(秒)
+        self.samples = deque(maxlen=window)  # 直近の成功レイテンシ (分位点用)
+        self.success = 1.0          # EWMA 成功率
+        self.failures = 0           # 連続失敗数
+        self.open_until = 0.0       # この時刻まではブレーカー開放 (使わない)
+        self.cooldown = cooldown    # 次に開放するときの長さ
+
+
+class Scoreboard:
+    def __init__(
+        self,
+        name: str = "",
+        alpha: float = 0.3,
+        initial_latency: float = 1.0,
+        fail_threshold: int = 3,
+        cooldown: float = 30,
+        max_cooldown: float = 600,
+        window: int = 50,
+    ):
+        self.name = name  # メトリクスのラベル用
+        self.alpha = alpha
+        self.initial_latency = initial_latency
+        self.fail_threshold = fail_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.window = window
+        self.stats = {}
+
+    def get(self, instance: str) -> InstanceStats:
+        s = self.stats.get(instance)
+        if s is None:
+            s = self.stats[instance] = InstanceStats(self.initial_latency, self.base_cooldown, self.window)
+        return s
+
+    def record_success(self, instance: str, latency: float):
+        s = self.get(instance)
+        s.latency += self.alpha * (latency - s.latency)
+        s.samples.append(latency)
+        s.success += self.alpha * (1.0 - s.success)
+        s.failures = 0
+        s.open_until = 0.0
+        s.cooldown = self.base_cooldown
+
+    def record_failure(self, instance: str, latency: float = None):
+        s = self.get(instance)
+        if latency is not None:
+            s.latency += self.alpha * (latency - s.latency)
+        s.success += self.alpha * (0.0 - s.success)
+        s.failures += 1
+        now = time.monotonic()
+        if s.failures >= self.fail_threshold and now >= s.open_until:
+            # 開放中でなければブレーカーを開く。半開状態で失敗したら期間を倍に
+            s.open_until = now + s.cooldown
+            s.cooldown = min(s.cooldown * 2, self.max_cooldown)
+
+    def is_open(self, instance: str) -> bool:
+        s = self.stats.get(instance)
+        return s is not None and time.monotonic() < s.open_until
+
+    def score(self, instance: str) -> float:
+        """小さいほど良い (成功までに掛かる期待時間の目安)"""
+        s = self.get(instance)
+        return s.latency / max(s.success, 0.05)
+
+    def percentile(self, instance: str, q: float = 0.9, min_samples: int = 5, default: float = None) -> float:
+        """直近の成功レイテンシの分位点。サンプルが少ないうちは default (None なら EWMA の2倍) で代用"""
+        s = self.get(instance)
+        if len(s.samples) < min_samples:
+            return s.latency * 2 if default is None else default
+        ordered = sorted(s.samples)
+        return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+    def healthy(self, instances, max_latency: float) -> bool:
+        """ブレーカーが閉じていて、成功率と速さが十分なインスタンスが1つでもあるか"""
+        now = time.monotonic()
+        for i in instances:
+            s = self.get(i)
+            if s.open_until <= now and s.success >= 0.5 and s.latency <= max_latency:
+                return True
+        return False
+
+    def ranked(self, instances) -> list:
+        """ブレーカーが閉じているものをスコア順に返す。全滅なら復帰が近い順"""
+        now = time.monotonic()
+        alive = [i for i in instances if self.get(i).open_until <= now]
+        if alive:
+            return sorted(alive, key=self.score)
+        return sorted(instances, key=lambda i: self.get(i).open_until)